@@ -13,13 +13,26 @@ import traceback
 import json
 import logging
 import logging.handlers
+import time
+import copy
+import hashlib
+import hmac
+import binascii
+import threading
 from operator import itemgetter
+from collections import OrderedDict
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 from socket import error as socket_error
 
 from ldapcherry.exceptions import *
 from ldapcherry.lclogging import *
 from ldapcherry.roles import Roles
 from ldapcherry.attributes import Attributes
+# makes ldapcherry.sessions.SQLiteSession usable in the configuration
+from ldapcherry.sessions import SQLiteSession
+from ldapcherry.backend import sort_key
+from ldapcherry.lrucache import LRUCache
 
 # Cherrypy http framework imports
 import cherrypy
@@ -38,6 +51,10 @@ else:
     from urllib.parse import quote_plus
 
 SESSION_KEY = '_cp_username'
+# attributes, groups and roles of the logged in user
+SESSION_CACHE_KEY = '_lc_user_cache'
+# pbkdf2 rounds of the passwords hashes in the authentication cache
+AUTH_CACHE_ROUNDS = 10000
 
 
 class LdapCherry(object):
@@ -80,9 +97,7 @@ class LdapCherry(object):
         @str username: name of the user
         @rtype: dict, format { '<backend>': [<list of groups>] }
         """
-        ret = {}
-        for b in self.backends:
-            ret[b] = self.backends[b].get_groups(username)
+        ret = dict(self._call_backends('get_groups', (username,)))
         cherrypy.log.error(
             msg="user '" + username + "' groups: " + str(ret),
             severity=logging.DEBUG,
@@ -103,6 +118,40 @@ class LdapCherry(object):
         )
         return user_roles
 
+    def _get_all_roles(self, usernames):
+        """ Get roles of several users at once (audit of the accounts)
+        @list usernames: names of the users
+        @rtype: dict, format { '<user>': <roles, same format as
+            _get_roles()> }
+        """
+        groups = {}
+        for username in usernames:
+            groups[username] = {}
+        for b, tmp in self._call_backends('get_groups_bulk', (usernames,)):
+            for username in tmp:
+                groups[username][b] = tmp[username]
+        return self.roles.get_roles_bulk(groups)
+
+    def audit_roles(self):
+        """ Get the roles of all the users (users returned by an empty
+        search), for ldapcherryd --audit-roles
+        @rtype: dict, format { '<user>': {'roles': [<roles>],
+            'unusedgroups': { '<backend>': [<groups>] } } }
+        """
+        users = list(self._search(''))
+        ret = {}
+        all_roles = self._get_all_roles(users)
+        for username in all_roles:
+            user_roles = all_roles[username]
+            unusedgroups = {}
+            for b in user_roles['unusedgroups']:
+                unusedgroups[b] = sorted(user_roles['unusedgroups'][b])
+            ret[username] = {
+                'roles': sorted(user_roles['roles']),
+                'unusedgroups': unusedgroups,
+            }
+        return ret
+
     def _is_admin(self, username):
         """ Check if a user is an ldapcherry administrator
         @str username: name of the user
@@ -111,15 +160,22 @@ class LdapCherry(object):
         roles = self._get_roles(username)
         return self.roles.is_admin(roles['roles'])
 
-    def _check_backends(self):
+    def _check_backends(self, roles=None, attributes=None):
         """ Check that every backend in roles and attributes
         is declared in main configuration
+        @Roles roles: roles to check (default: current roles)
+        @Attributes attributes: attributes to check
+            (default: current attributes)
         """
+        if roles is None:
+            roles = self.roles
+        if attributes is None:
+            attributes = self.attributes
         backends = self.backends_params.keys()
-        for b in self.roles.get_backends():
+        for b in roles.get_backends():
             if b not in backends:
                 raise MissingBackend(b, 'role')
-        for b in self.attributes.get_backends():
+        for b in attributes.get_backends():
             if b not in backends:
                 raise MissingBackend(b, 'attribute')
 
@@ -145,32 +201,133 @@ class LdapCherry(object):
             except Exception as e:
                 self.backends_display_names[backend] = backend
                 self.backends_params[backend]['display_name'] = backend
-            params = self.backends_params[backend]
-            # Loading the backend module
-            try:
-                module = params['module']
-            except Exception as e:
-                raise MissingParameter('backends', backend + '.module')
-            try:
-                bc = __import__(module, globals(), locals(), ['Backend'], 0)
-            except Exception as e:
-                self._handle_exception(e)
-                raise BackendModuleLoadingFail(module)
+            self.backends[backend] = self._init_backend(
+                backend,
+                self.attributes,
+                )
+
+    def _init_backend(self, backend, attributes):
+        """ Init one backend
+        @str backend: name of the backend
+        @Attributes attributes: attributes configuration
+        @rtype: the backend object
+        """
+        params = self.backends_params[backend]
+        # Loading the backend module
+        try:
+            module = params['module']
+        except Exception as e:
+            raise MissingParameter('backends', backend + '.module')
+        try:
+            bc = __import__(module, globals(), locals(), ['Backend'], 0)
+        except Exception as e:
+            self._handle_exception(e)
+            raise BackendModuleLoadingFail(module)
+        try:
+            attrslist = attributes.get_backend_attributes(backend)
+            key = attributes.get_backend_key(backend)
+            ret = bc.Backend(
+                params,
+                cherrypy.log.error,
+                backend,
+                attrslist,
+                key,
+                )
+            ret.set_displayed_attrs(
+                attributes.get_backend_search_attributes(backend)
+                )
+        except MissingParameter as e:
+            raise
+        except Exception as e:
+            self._handle_exception(e)
+            raise BackendModuleInitFail(module)
+        return ret
+
+    def _backend_attributes(self, attributes, backend):
+        """ Attributes configuration of a backend
+        (the backend must be created again if it changes)
+        @Attributes attributes: attributes configuration
+        @str backend: name of the backend
+        @rtype: tuple (attributes, key, displayed attributes)
+        """
+        return (
+            attributes.get_backend_attributes(backend),
+            attributes.get_backend_key(backend),
+            attributes.get_backend_search_attributes(backend),
+            )
+
+    def _init_fanout(self, config):
+        """ Init the thread pool used to call the backends in parallel
+        @dict: configuration of ldapcherry
+        """
+        # default: enough threads for every request thread
+        # to call all the backends at the same time
+        default_threads = len(self.backends) * int(
+            self._get_param('global', 'server.thread_pool', config, 10)
+            )
+        threads = int(
+            self._get_param('fanout', 'fanout.threads', config,
+                            default_threads)
+            )
+        timeout = float(
+            self._get_param('fanout', 'fanout.timeout', config, 0)
+            )
+        self.fanout_timeout = timeout or None
+        old_pool = getattr(self, 'fanout_pool', None)
+        if threads > 0 and len(self.backends) > 1:
+            self.fanout_pool = ThreadPool(threads)
+        else:
+            self.fanout_pool = None
+        if old_pool is not None:
+            old_pool.close()
+
+    def _call_backends(self, method, args=(), expected=()):
+        """ Call a method with the same arguments on every backend
+        @str method: name of the backend method
+        @tuple args: arguments of the method
+        @tuple expected: see _fanout()
+        @rtype: list of (<backend>, <result>), in backends order
+        """
+        calls = []
+        for b in self.backends:
+            calls.append((b, getattr(self.backends[b], method), args))
+        return self._fanout(calls, expected)
+
+    def _fanout(self, calls, expected=()):
+        """ Run backend calls, in parallel if the fan-out
+        thread pool is enabled
+        @list calls: list of (<backend>, <function>, <arguments tuple>)
+        @tuple expected: exception types returned as result of a call
+            instead of being raised
+        @rtype: list of (<backend>, <result>), in calls order
+        """
+        ret = []
+        if self.fanout_pool is None:
+            for b, func, args in calls:
+                try:
+                    ret.append((b, func(*args)))
+                except expected as e:
+                    ret.append((b, e))
+            return ret
+
+        pending = []
+        for b, func, args in calls:
+            pending.append((b, self.fanout_pool.apply_async(func, args)))
+        if self.fanout_timeout is not None:
+            deadline = time.time() + self.fanout_timeout
+        for b, res in pending:
             try:
-                attrslist = self.attributes.get_backend_attributes(backend)
-                key = self.attributes.get_backend_key(backend)
-                self.backends[backend] = bc.Backend(
-                    params,
-                    cherrypy.log.error,
-                    backend,
-                    attrslist,
-                    key,
+                if self.fanout_timeout is None:
+                    ret.append((b, res.get()))
+                else:
+                    ret.append(
+                        (b, res.get(max(0, deadline - time.time())))
                     )
-            except MissingParameter as e:
-                raise
-            except Exception as e:
-                self._handle_exception(e)
-                raise BackendModuleInitFail(module)
+            except TimeoutError:
+                raise BackendTimeout(b, self.fanout_timeout)
+            except expected as e:
+                ret.append((b, e))
+        return ret
 
     def _init_custom_js(self, config):
         self.custom_js = []
@@ -221,12 +378,60 @@ class LdapCherry(object):
                 ['and', 'or', 'none', 'custom'],
                 )
 
+        # cache of the successful authentications (disabled by default)
+        auth_cache_ttl = int(
+            self._get_param('auth', 'auth.cache_ttl', config, 0)
+        )
+        if auth_cache_ttl:
+            auth_cache_size = int(
+                self._get_param('auth', 'auth.cache_size', config, 1000)
+            )
+            self.auth_cache = LRUCache(auth_cache_size, auth_cache_ttl)
+            # random salt, the hashes are only valid in this process
+            self.auth_cache_salt = os.urandom(16)
+        else:
+            self.auth_cache = None
+
         self.roles_file = self._get_param('roles', 'roles.file', config)
         cherrypy.log.error(
             msg="loading roles file '%(file)s'" % {'file': self.roles_file},
             severity=logging.DEBUG
         )
-        self.roles = Roles(self.roles_file)
+        self.roles_cache_size = int(
+            self._get_param('roles', 'roles.cache_size', config, 1000)
+        )
+        # compiled version of the roles file (optional)
+        self.roles_compiled_file = self._get_param(
+            'roles',
+            'roles.compiled_file',
+            config,
+            False,
+        ) or None
+        self.roles = self._load_roles()
+
+    def _load_roles(self):
+        """ Load the roles file, or its compiled version if it is
+        up to date (the compiled file is written otherwise)
+        @rtype: Roles
+        """
+        roles = Roles(
+            self.roles_file,
+            self.roles_cache_size,
+            self.roles_compiled_file,
+        )
+        if self.roles_compiled_file is not None and not roles.compiled:
+            try:
+                roles.save_compiled(self.roles_compiled_file)
+            except (IOError, OSError) as e:
+                cherrypy.log.error(
+                    msg="failed to write compiled roles file"
+                        " '%(file)s': %(error)s" % {
+                            'file': self.roles_compiled_file,
+                            'error': str(e),
+                        },
+                    severity=logging.WARNING
+                )
+        return roles
 
     def _set_access_log(self, config, level):
         """ Configure access logs
@@ -336,8 +541,42 @@ class LdapCherry(object):
             cherrypy.log.error_log.addHandler(handler)
             cherrypy.log.error_log.setLevel(logging.DEBUG)
 
+    def _auth_digest(self, user, password):
+        """ salted slow hash of the credentials of a user
+        @str user: login of the user
+        @str password: password of the user
+        @rtype: str, hexadecimal digest
+        """
+        credentials = user + '\0' + password
+        if not isinstance(credentials, bytes):
+            credentials = credentials.encode('utf-8')
+        digest = hashlib.pbkdf2_hmac(
+            'sha256',
+            credentials,
+            self.auth_cache_salt,
+            AUTH_CACHE_ROUNDS,
+            )
+        return binascii.hexlify(digest)
+
+    @staticmethod
+    def _auth_cache_key(user):
+        """ key of a user in the authentication cache
+        (logins are matched regardless of case by the backends)
+        @str user: login of the user
+        @rtype: str, cache key
+        """
+        return user.lower()
+
+    def _invalidate_auth(self, user):
+        """ remove a user from the authentication cache
+        @str user: login of the user
+        """
+        if self.auth_cache is not None:
+            self.auth_cache.invalidate(self._auth_cache_key(user))
+
     def _auth(self, user, password):
         """ authenticate a user
+        (successful authentications are cached if auth.cache_ttl is set)
         @str user: login of the user
         @str password: password of the user
         @rtype: dict, {'connected': <boolean, True if connection succeded>,
@@ -345,14 +584,37 @@ class LdapCherry(object):
         """
         if self.auth_mode == 'none':
             return {'connected': True, 'isadmin': True}
-        elif self.auth_mode == 'and':
+        if self.auth_cache is None:
+            return self._auth_backends(user, password)
+        key = self._auth_cache_key(user)
+        digest = self._auth_digest(user, password)
+        cached = self.auth_cache.get(key)
+        if cached is not None and hmac.compare_digest(cached[0], digest):
+            cherrypy.log.error(
+                msg="user '" + user + "' authenticated from cache",
+                severity=logging.DEBUG,
+            )
+            return dict(cached[1])
+        ret = self._auth_backends(user, password)
+        if ret['connected']:
+            self.auth_cache.set(key, (digest, dict(ret)))
+        return ret
+
+    def _auth_backends(self, user, password):
+        """ authenticate a user against the backends
+        @str user: login of the user
+        @str password: password of the user
+        @rtype: dict, {'connected': <boolean, True if connection succeded>,
+            'isadmin': <True if user is ldapcherry administrator>}
+        """
+        if self.auth_mode == 'and':
             ret1 = True
-            for b in self.backends:
-                ret1 = self.backends[b].auth(user, password) and ret1
+            for b, auth in self._call_backends('auth', (user, password)):
+                ret1 = auth and ret1
         elif self.auth_mode == 'or':
             ret1 = False
-            for b in self.backends:
-                ret1 = self.backends[b].auth(user, password) or ret1
+            for b, auth in self._call_backends('auth', (user, password)):
+                ret1 = auth or ret1
         elif self.auth_mode == 'custom':
             ret1 = self.auth.auth(user, password)
         else:
@@ -363,6 +625,28 @@ class LdapCherry(object):
             isadmin = self._is_admin(user)
             return {'connected': True, 'isadmin': isadmin}
 
+    def _render_roles(self, current_roles=None):
+        """ render the roles form
+        (the empty form of the add user page is rendered only once
+        per roles configuration)
+        @list current_roles: roles to check in the form
+        @rtype: str, the roles form
+        """
+        if current_roles is None:
+            cached = self.roles_form
+            if cached is not None and cached[0] is self.roles:
+                return cached[1]
+        roles = self.temp['roles.tmpl'].render(
+            roles=self.roles.flatten,
+            graph=self.roles.graph,
+            graph_js=self.roles.graph_js,
+            roles_js=self.roles.roles_js,
+            current_roles=current_roles,
+            )
+        if current_roles is None:
+            self.roles_form = (self.roles, roles)
+        return roles
+
     def _load_templates(self, config):
         """ load templates
         @dict: configuration of ldapcherry
@@ -385,6 +669,8 @@ class LdapCherry(object):
             )
         # load each template
         self.temp = {}
+        # rendered empty roles form (see _render_roles)
+        self.roles_form = None
         for t in ('index.tmpl', 'error.tmpl', 'login.tmpl', '404.tmpl',
                   'searchadmin.tmpl', 'searchuser.tmpl', 'adduser.tmpl',
                   'roles.tmpl', 'groups.tmpl', 'form.tmpl', 'selfmodify.tmpl',
@@ -392,9 +678,12 @@ class LdapCherry(object):
                   ):
             self.temp[t] = self.temp_lookup.get_template(t)
 
-    def reload(self, config=None, debug=False):
+    def reload(self, config=None, debug=False, check_only=False):
         """ load/reload configuration
         @dict: configuration of ldapcherry
+        @bool check_only: only check the configuration, the fan-out
+            thread pool is not started (master process of
+            ldapcherryd --workers, the workers load it again)
         """
         try:
             # log configuration handling
@@ -438,6 +727,21 @@ class LdapCherry(object):
             )
             self._init_backends(config)
             self._check_backends()
+            if check_only:
+                self.fanout_pool = None
+            else:
+                self._init_fanout(config)
+
+            # time the logged in user is cached in his session
+            # (0: no cache)
+            self.session_cache_ttl = int(
+                self._get_param('session', 'session.cache_ttl', config, 0)
+            )
+
+            # number of users per page in search pages (0: no paging)
+            self.search_page_size = int(
+                self._get_param('search', 'search.page_size', config, 0)
+            )
 
             # loading the ppolicy
             self._init_ppolicy(config)
@@ -445,6 +749,17 @@ class LdapCherry(object):
             # loading custom javascript
             self._init_custom_js(config)
 
+            # interval between the checks of the roles
+            # and attributes files (0: never reloaded)
+            self.files_reload_interval = int(
+                self._get_param('roles', 'roles.reload_interval', config, 0)
+            )
+            self.files_lock = threading.Lock()
+            self.files_signatures = self._files_signatures()
+            # incremented at each reload of the roles and attributes
+            self.files_generation = \
+                getattr(self, 'files_generation', -1) + 1
+
             cherrypy.log.error(
                 msg="application started",
                 severity=logging.INFO
@@ -458,6 +773,87 @@ class LdapCherry(object):
             )
             exit(1)
 
+    def _files_signatures(self):
+        """ signatures of the roles and attributes files,
+        to detect their changes
+        @rtype: dict, {<file>: (<modification time>, <size>)}
+        """
+        ret = {}
+        for f in (self.roles_file, self.attributes_file):
+            st = os.stat(f)
+            ret[f] = (st.st_mtime, st.st_size)
+        return ret
+
+    def reload_files(self, force=False):
+        """ reload the roles and attributes files if they changed
+
+        The new roles and attributes are loaded and checked before
+        replacing the current ones (kept if the new files are invalid),
+        only the backends whose attributes changed are created again.
+        @bool force: reload the files even if they didn't change
+        @rtype: bool, True if the files were reloaded
+        """
+        with self.files_lock:
+            try:
+                signatures = self._files_signatures()
+            except OSError as e:
+                # file being replaced, try again later
+                self._handle_exception(e)
+                return False
+            try:
+                roles = self.roles
+                attributes = self.attributes
+                if force or signatures[self.roles_file] != \
+                        self.files_signatures[self.roles_file]:
+                    cherrypy.log.error(
+                        msg="reloading roles file '%(file)s'" %
+                            {'file': self.roles_file},
+                        severity=logging.INFO
+                    )
+                    roles = self._load_roles()
+                if force or signatures[self.attributes_file] != \
+                        self.files_signatures[self.attributes_file]:
+                    cherrypy.log.error(
+                        msg="reloading attributes file '%(file)s'" %
+                            {'file': self.attributes_file},
+                        severity=logging.INFO
+                    )
+                    attributes = Attributes(self.attributes_file)
+                if roles is self.roles and attributes is self.attributes:
+                    return False
+                self._check_backends(roles, attributes)
+                backends = {}
+                for b in self.backends:
+                    if self._backend_attributes(attributes, b) == \
+                            self._backend_attributes(self.attributes, b):
+                        backends[b] = self.backends[b]
+                    else:
+                        backends[b] = self._init_backend(b, attributes)
+            except Exception as e:
+                self._handle_exception(e)
+                cherrypy.log.error(
+                    msg="failed to reload the roles and attributes files,"
+                        " keeping the current configuration",
+                    severity=logging.ERROR
+                )
+                # don't try again until the files change again
+                self.files_signatures = signatures
+                return False
+
+            self.backends = backends
+            self.attributes = attributes
+            self.roles = roles
+            self.files_signatures = signatures
+            self.files_generation += 1
+            # the roles of the users may have changed
+            if self.auth_cache is not None:
+                self.auth_cache.clear()
+            cherrypy.log.error(
+                msg="roles and attributes files reloaded",
+                severity=logging.INFO
+            )
+            return True
+
     def _add_notification(self, message):
         """ add a notification in the notification queue of a user
         """
@@ -498,14 +894,114 @@ class LdapCherry(object):
         if searchstring is None:
             return {}
         ret = {}
-        for b in self.backends:
-            tmp = self.backends[b].search(searchstring)
+        for b, tmp in self._call_backends('search', (searchstring,)):
             for u in tmp:
                 if u not in ret:
                     ret[u] = {}
                 self._merge_user_attrs(tmp[u], ret[u], b)
         return ret
 
+    def _search_window(self, searchstring, sort, offset, limit):
+        """ search users, sorted on an attribute and restricted to a window
+        of the results (sorting and windowing are done by the backends
+        when possible)
+        @str searchstring: search string
+        @str sort: attribute to sort on ('-' prefix for descending order)
+        @int offset: index of the first user to return
+        @int limit: maximum number of users to return
+        @rtype: (OrderedDict {<user>: {<attr>: <value>}},
+            int number of users matching the search)
+        """
+        attrid = sort.lstrip('-')
+        order = sort[:len(sort) - len(attrid)]
+        backends_attrs = self.attributes.get_backends_attributes(attrid)
+        # with only one backend, the backend directly returns the window,
+        # with several, the window can start in any of them, so the first
+        # offset + limit users of each backend are merged and sorted
+        windowed = len(self.backends) == 1
+        calls = []
+        for b in self.backends:
+            if b in backends_attrs:
+                if windowed:
+                    b_offset, b_limit = offset, limit
+                else:
+                    b_offset, b_limit = 0, offset + limit
+                calls.append((
+                    b,
+                    self.backends[b].search_sorted,
+                    (searchstring, order + backends_attrs[b],
+                     b_offset, b_limit),
+                    ))
+            else:
+                # backend can't sort on this attribute
+                windowed = False
+                calls.append((b, self.backends[b].search, (searchstring,)))
+        ret = {}
+        total = 0
+        for b, tmp in self._fanout(calls):
+            if isinstance(tmp, tuple):
+                tmp, count = tmp
+            else:
+                count = len(tmp)
+            # users are generally present in all the backends
+            total = max(total, count)
+            for u in tmp:
+                if u not in ret:
+                    ret[u] = {}
+                self._merge_user_attrs(tmp[u], ret[u], b)
+        total = max(total, len(ret))
+        users = sorted(
+            ret,
+            key=lambda u: (sort_key(ret[u].get(attrid)), u),
+            reverse=bool(order),
+            )
+        if windowed:
+            users = users[:limit]
+        else:
+            users = users[offset:offset + limit]
+        window = OrderedDict()
+        for u in users:
+            window[u] = ret[u]
+        return (window, total)
+
+    def _search_page(self, searchstring, sort=None, offset=0, limit=None):
+        """ search users for the search pages
+        @str searchstring: search string
+        @str sort: attribute to sort on ('-' prefix for descending order,
+            default is the key attribute)
+        @str offset: index of the first user to display
+        @str limit: number of users to display per page
+            (default is search.page_size, 0 to display all the users)
+        @rtype: (dict {<user>: {<attr>: <value>}},
+            dict describing the page, None if results are not paged)
+        """
+        if limit is None or limit == '':
+            limit = self.search_page_size
+        try:
+            offset = int(offset)
+            limit = int(limit)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "bad argument")
+        if offset < 0 or limit < 0:
+            raise cherrypy.HTTPError(400, "bad argument")
+        if limit == 0:
+            return (self._search(searchstring), None)
+        if not sort:
+            sort = self.attributes.get_key()
+        attrid = sort.lstrip('-')
+        if attrid not in self.attributes.get_search_attributes() and \
+                attrid != self.attributes.get_key():
+            raise cherrypy.HTTPError(400, "bad argument")
+        res, total = self._search_window(searchstring, sort, offset, limit)
+        window = {
+            'searchstring': searchstring,
+            'sort': sort,
+            'offset': offset,
+            'limit': limit,
+            'total': total,
+        }
+        return (res, window)
+
     def _get_user(self, username):
         """ get user attributes
         @str username: user to get
@@ -514,11 +1010,10 @@ class LdapCherry(object):
         if username is None:
             return {}
         ret = {}
-        for b in self.backends:
-            try:
-                tmp = self.backends[b].get_user(username)
-            except UserDoesntExist as e:
-                self._handle_exception(e)
+        for b, tmp in self._call_backends(
+                'get_user', (username,), (UserDoesntExist,)):
+            if isinstance(tmp, UserDoesntExist):
+                self._handle_exception(tmp)
                 tmp = {}
             self._merge_user_attrs(tmp, ret, b)
 
@@ -528,6 +1023,55 @@ class LdapCherry(object):
         )
         return ret
 
+    def _load_session_user(self, username, item):
+        """ get the attributes, groups or roles of a user
+        @str username: name of the user
+        @str item: 'attrs', 'groups' or 'roles'
+        @rtype: dict
+        """
+        if item == 'attrs':
+            return self._get_user(username)
+        elif item == 'groups':
+            return self._get_groups(username)
+        else:
+            groups = self._get_session_user('groups')
+            return self.roles.get_roles(groups)
+
+    def _get_session_user(self, item):
+        """ get the attributes, groups or roles of the logged in user
+        (cached in the session for session.cache_ttl seconds)
+        @str item: 'attrs', 'groups' or 'roles'
+        @rtype: dict
+        """
+        username = self._check_session()
+        if not self.session_cache_ttl:
+            return self._load_session_user(username, item)
+        sess = cherrypy.session
+        cache = sess.get(SESSION_CACHE_KEY)
+        now = time.time()
+        if cache is None or cache['user'] != username or \
+                cache['expire'] <= now or \
+                cache.get('generation') != self.files_generation:
+            cache = {
+                'user': username,
+                'expire': now + self.session_cache_ttl,
+                'generation': self.files_generation,
+            }
+        if item not in cache:
+            cache[item] = self._load_session_user(username, item)
+            sess[SESSION_CACHE_KEY] = cache
+        # the page handlers are free to modify the result
+        return copy.deepcopy(cache[item])
+
+    def _refresh_session_user(self, username=None):
+        """ drop the cached attributes, groups and roles
+        of the logged in user
+        @str username: only drop them if the logged in user is username
+        """
+        if username is not None and username != self._check_session():
+            return
+        cherrypy.session.pop(SESSION_CACHE_KEY, None)
+
     def _parse_params(self, params):
         """ get user attributes
         @dict params: form parameters
@@ -554,10 +1098,15 @@ class LdapCherry(object):
     def _check_admin(self):
         """ check in the session database if current user
         is an ldapcherry administrator
+        (from his cached roles if session.cache_ttl is set, the status
+        follows the changes of his roles)
         @rtype: boolean, True if administrator, False otherwise
         """
         if self.auth_mode == 'none':
             return True
+        if self.session_cache_ttl and cherrypy.session.get('connected'):
+            roles = self._get_session_user('roles')
+            return self.roles.is_admin(roles['roles'])
         return cherrypy.session['isadmin']
 
     def _check_session(self):
@@ -608,8 +1157,8 @@ class LdapCherry(object):
                     "You must be logged in to access this ressource.",
                     )
 
-        if cherrypy.session['connected'] and \
-                not cherrypy.session['isadmin']:
+        is_admin = self._check_admin()
+        if cherrypy.session['connected'] and not is_admin:
             if must_admin:
                 # user is not an administrator, so he gets 403 Forbidden
                 raise cherrypy.HTTPError(
@@ -619,8 +1168,7 @@ class LdapCherry(object):
             else:
                 return username
 
-        if cherrypy.session['connected'] and \
-                cherrypy.session['isadmin']:
+        if cherrypy.session['connected'] and is_admin:
             return username
         else:
             if redir_login:
@@ -730,6 +1278,11 @@ class LdapCherry(object):
                 self._add_notification(
                     'User does not exist in backend "' + b + '"'
                     )
+        # the cached authentication is no longer valid
+        for attr in attr_list:
+            if self.attributes.attributes[attr]['type'] == 'password' and \
+                    attr in params['attrs'] and params['attrs'][attr] != '':
+                self._invalidate_auth(username)
 
         return badd
 
@@ -846,6 +1399,8 @@ class LdapCherry(object):
                 severity=logging.DEBUG
             )
             self.backends[b].del_from_groups(username, tmp)
+        # the administrator status may have changed
+        self._invalidate_auth(username)
 
         cherrypy.log.error(
             msg="user '" + username + "' made member of " +
@@ -856,11 +1411,11 @@ class LdapCherry(object):
     def _deleteuser(self, username):
         sess = cherrypy.session
         admin = sess.get(SESSION_KEY, 'unknown')
+        self._invalidate_auth(username)
 
-        for b in self.backends:
-            try:
-                self.backends[b].del_user(username)
-            except UserDoesntExist as e:
+        for b, res in self._call_backends(
+                'del_user', (username,), (UserDoesntExist,)):
+            if isinstance(res, UserDoesntExist):
                 cherrypy.log.error(
                     msg="User '" + username +
                         "' didn't exist in backend '" + b + "'",
@@ -911,6 +1466,7 @@ class LdapCherry(object):
                 severity=logging.INFO
             )
             cherrypy.session[SESSION_KEY] = cherrypy.request.login = login
+            self._refresh_session_user()
             if url is None:
                 redirect = "/"
             else:
@@ -954,12 +1510,10 @@ class LdapCherry(object):
         """
         self._check_auth(must_admin=False)
         is_admin = self._check_admin()
-        sess = cherrypy.session
-        user = sess.get(SESSION_KEY, None)
         if self.auth_mode == 'none':
             user_attrs = None
         else:
-            user_attrs = self._get_user(user)
+            user_attrs = self._get_session_user('attrs')
         attrs_list = self.attributes.get_search_attributes()
         return self.temp['index.tmpl'].render(
             is_admin=is_admin,
@@ -970,17 +1524,18 @@ class LdapCherry(object):
 
     @cherrypy.expose
     @exception_decorator
-    def searchuser(self, searchstring=None):
+    def searchuser(self, searchstring=None, sort=None, offset=0, limit=None):
         """ search user page """
         self._check_auth(must_admin=False)
         is_admin = self._check_admin()
         if searchstring is not None and len(searchstring) > 2:
-            res = self._search(searchstring)
+            res, window = self._search_page(searchstring, sort, offset, limit)
         else:
-            res = None
+            res, window = None, None
         attrs_list = self.attributes.get_search_attributes()
         return self.temp['searchuser.tmpl'].render(
             searchresult=res,
+            window=window,
             attrs_list=attrs_list,
             is_admin=is_admin,
             custom_js=self.custom_js,
@@ -1007,17 +1562,18 @@ class LdapCherry(object):
 
     @cherrypy.expose
     @exception_decorator
-    def searchadmin(self, searchstring=None):
+    def searchadmin(self, searchstring=None, sort=None, offset=0, limit=None):
         """ search user page """
         self._check_auth(must_admin=True)
         is_admin = self._check_admin()
         if searchstring is not None:
-            res = self._search(searchstring)
+            res, window = self._search_page(searchstring, sort, offset, limit)
         else:
-            res = None
+            res, window = None, None
         attrs_list = self.attributes.get_search_attributes()
         return self.temp['searchadmin.tmpl'].render(
             searchresult=res,
+            window=window,
             attrs_list=attrs_list,
             is_admin=is_admin,
             custom_js=self.custom_js,
@@ -1036,16 +1592,6 @@ class LdapCherry(object):
             self._adduser(params)
             self._add_notification("User added")
 
-        graph = {}
-        for r in self.roles.graph:
-            s = list(self.roles.graph[r]['sub_roles'])
-            p = list(self.roles.graph[r]['parent_roles'])
-            graph[r] = {'sub_roles': s, 'parent_roles': p}
-        graph_js = json.dumps(graph, separators=(',', ':'))
-        display_names = {}
-        for r in self.roles.flatten:
-            display_names[r] = self.roles.flatten[r]['display_name']
-        roles_js = json.dumps(display_names, separators=(',', ':'))
         try:
             form = self.temp['form.tmpl'].render(
                 attributes=self.attributes.attributes,
@@ -1053,13 +1599,7 @@ class LdapCherry(object):
                 modify=False,
                 autofill=True
                 )
-            roles = self.temp['roles.tmpl'].render(
-                roles=self.roles.flatten,
-                graph=self.roles.graph,
-                graph_js=graph_js,
-                roles_js=roles_js,
-                current_roles=None,
-                )
+            roles = self._render_roles()
             return self.temp['adduser.tmpl'].render(
                 form=form,
                 roles=roles,
@@ -1096,6 +1636,9 @@ class LdapCherry(object):
         if cherrypy.request.method.upper() == 'POST':
             params = self._parse_params(params)
             self._modify(params)
+            self._refresh_session_user(
+                params['attrs'][self.attributes.get_key()]
+            )
             self._add_notification("User modified")
             try:
                 referer = cherrypy.request.headers['Referer']
@@ -1103,16 +1646,6 @@ class LdapCherry(object):
                 referer = '/'
             raise cherrypy.HTTPRedirect(referer)
 
-        graph = {}
-        for r in self.roles.graph:
-            s = list(self.roles.graph[r]['sub_roles'])
-            p = list(self.roles.graph[r]['parent_roles'])
-            graph[r] = {'sub_roles': s, 'parent_roles': p}
-        graph_js = json.dumps(graph, separators=(',', ':'))
-        display_names = {}
-        for r in self.roles.flatten:
-            display_names[r] = self.roles.flatten[r]['display_name']
-
         if user is None:
             cherrypy.response.status = 400
             return self.temp['error.tmpl'].render(
@@ -1121,7 +1654,11 @@ class LdapCherry(object):
                 message="No user requested"
                 )
 
-        user_attrs = self._get_user(user)
+        # the logged in user is cached in his session
+        if user == self._check_session():
+            user_attrs = self._get_session_user('attrs')
+        else:
+            user_attrs = self._get_user(user)
         if user_attrs == {}:
             cherrypy.response.status = 400
             return self.temp['error.tmpl'].render(
@@ -1129,10 +1666,12 @@ class LdapCherry(object):
                 alert='warning',
                 message="User '" + user + "' does not exist"
                 )
-        tmp = self._get_roles(user)
+        if user == self._check_session():
+            tmp = self._get_session_user('roles')
+        else:
+            tmp = self._get_roles(user)
         user_roles = tmp['roles']
         standalone_groups = tmp['unusedgroups']
-        roles_js = json.dumps(display_names, separators=(',', ':'))
         key = self.attributes.get_key()
 
         try:
@@ -1144,13 +1683,7 @@ class LdapCherry(object):
                 autofill=False
                 )
 
-            roles = self.temp['roles.tmpl'].render(
-                roles=self.roles.flatten,
-                graph=self.roles.graph,
-                graph_js=graph_js,
-                roles_js=roles_js,
-                current_roles=user_roles,
-            )
+            roles = self._render_roles(user_roles)
 
             glued_template = self.temp['modify.tmpl'].render(
                 form=form,
@@ -1185,8 +1718,6 @@ class LdapCherry(object):
         """ self modify user page """
         self._check_auth(must_admin=False)
         is_admin = self._check_admin()
-        sess = cherrypy.session
-        user = sess.get(SESSION_KEY, None)
         if self.auth_mode == 'none':
             return self.temp['error.tmpl'].render(
                 is_admin=is_admin,
@@ -1196,10 +1727,11 @@ class LdapCherry(object):
         if cherrypy.request.method.upper() == 'POST':
             params = self._parse_params(params)
             self._selfmodify(params)
+            self._refresh_session_user()
             self._add_notification(
                 "Self modification done"
             )
-        user_attrs = self._get_user(user)
+        user_attrs = self._get_session_user('attrs')
 
         try:
             if user_attrs == {}:
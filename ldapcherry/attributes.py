@@ -134,6 +134,18 @@ class Attributes:
         ret.sort()
         return ret
 
+    def get_backend_search_attributes(self, backend):
+        """return the backend attributes displayed in search results"""
+        if backend not in self.backends:
+            raise WrongBackend(backend)
+        ret = []
+        for attrid in self.displayed_attributes:
+            backends = self.displayed_attributes[attrid]['backends']
+            if backend in backends:
+                ret.append(backends[backend])
+        ret.sort()
+        return ret
+
     def get_backend_key(self, backend):
         if backend not in self.backends:
             raise WrongBackend(backend)
@@ -5,7 +5,23 @@
 # LdapCherry
 # Copyright (c) 2014 Carpentier Pierre-Francois
 
-from ldapcherry.exceptions import MissingParameter
+from collections import OrderedDict
+from ldapcherry.exceptions import MissingParameter, UserDoesntExist
+
+
+def sort_key(value):
+    """ Key used to sort users on an attribute value
+    (case insensitive, first value for multivalued attributes)
+
+    :param value: the attribute value
+    :type value: string, list of strings or None
+    :rtype: string
+    """
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if value is None:
+        return ''
+    return ('%s' % value).lower()
 
 
 class Backend(object):
@@ -97,6 +113,38 @@ class Backend(object):
         """
         return {}
 
+    def search_sorted(self, searchstring, sort, offset=0, limit=None):
+        """ Search backend for users, sorted on an attribute and
+        restricted to a window of the results
+
+        :param searchstring: the search string
+        :type searchstring: string
+        :param sort: backend attribute to sort on
+            (prefixed by '-' for a descending order)
+        :type sort: string
+        :param offset: index of the first user to return
+        :type offset: int
+        :param limit: maximum number of users to return (None for all)
+        :type limit: int or None
+        :rtype: tuple (ordered dict of dict like search(),
+            total number of users matching the search)
+        """
+        res = self.search(searchstring)
+        attr = sort.lstrip('-')
+        users = sorted(
+            res,
+            key=lambda u: (sort_key(res[u].get(attr)), u),
+            reverse=sort.startswith('-'),
+            )
+        if limit is not None:
+            users = users[offset:offset + limit]
+        else:
+            users = users[offset:]
+        ret = OrderedDict()
+        for u in users:
+            ret[u] = res[u]
+        return (ret, len(res))
+
     def get_user(self, username):
         """ Get a user's attributes
 
@@ -117,6 +165,35 @@ class Backend(object):
         """
         return []
 
+    def get_groups_bulk(self, usernames):
+        """ Get the groups of several users at once
+
+        :param usernames: 'key' attributes of the users
+        :type usernames: list of strings
+        :rtype: dict of lists ( {<username>: [<groups>]} )
+
+        .. note:: by default, get_groups() is called for each user,
+            backends should implement a faster way if possible
+            (users not in the backend have no groups)
+        """
+        ret = {}
+        for username in usernames:
+            try:
+                ret[username] = self.get_groups(username)
+            except UserDoesntExist:
+                ret[username] = []
+        return ret
+
+    def set_displayed_attrs(self, attrslist):
+        """ Set the attributes displayed in search results
+        (searches can be restricted to these attributes)
+
+        :param attrslist: list of the backend attributes displayed
+            in search results
+        :type attrslist: list of strings
+        """
+        self.displayed_attrs = attrslist
+
     def get_param(self, param, default=None):
         """ Get a parameter in config (handle default value)
 
@@ -112,6 +112,7 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
         self.starttls = self.get_param('starttls', 'off')
         self.uri = self.get_param('uri')
         self.timeout = self.get_param('timeout', 1)
+        self.page_size = int(self.get_param('page_size', 0))
         self.userdn = 'CN=Users,' + basedn
         self.groupdn = self.userdn
         self.builtin = 'CN=Builtin,' + basedn
@@ -128,6 +129,8 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
             '(!(objectClass=computer)))' \
             ')'
         self.dn_user_attr = 'cn'
+        # read the groups from memberOf instead of searching them
+        self.membership_attr = self.get_param('membership_attr', False)
         self.key = 'sAMAccountName'
         self.objectclasses = [
             self._byte_p23('top'),
@@ -144,6 +147,7 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
         self.group_attrs_keys = []
         for a in attrslist:
             self.attrlist.append(self._byte_p2(a))
+        self.displayed_attrlist = self.attrlist
 
         if self._byte_p2('cn') not in self.attrlist:
             raise MissingAttr()
@@ -151,6 +155,11 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
         if self._byte_p2('unicodePwd') not in self.attrlist:
             raise MissingAttr()
 
+        self._init_templates()
+        self._init_options()
+        self._init_pool()
+        self._init_dn_cache()
+
     if sys.version < '3':
         @staticmethod
         def _tobyte(in_int):
@@ -162,19 +171,16 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
 
     def _search_group(self, searchfilter, groupdn):
         searchfilter = self._byte_p2(searchfilter)
-        ldap_client = self._bind()
-        try:
-            r = ldap_client.search_s(
-                groupdn,
-                ldap.SCOPE_SUBTREE,
-                searchfilter,
-                attrlist=['CN']
-                )
-        except Exception as e:
-            ldap_client.unbind_s()
-            self._exception_handler(e)
-
-        ldap_client.unbind_s()
+        with self._operation() as ldap_client:
+            try:
+                r = ldap_client.search_s(
+                    groupdn,
+                    ldap.SCOPE_SUBTREE,
+                    searchfilter,
+                    attrlist=['CN']
+                    )
+            except Exception as e:
+                self._exception_handler(e)
         return r
 
     def _build_groupdn(self, groups):
@@ -190,8 +196,6 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
         unicode_pass = '\"' + password + '\"'
         password_value = unicode_pass.encode('utf-16-le')
 
-        ldap_client = self._bind()
-
         if by_cn:
             dn = self._byte_p2('CN=%(cn)s,%(user_dn)s' % {
                         'cn': name,
@@ -204,49 +208,70 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
 
         attrs['unicodePwd'] = self._modlist(self._byte_p2(password_value))
 
-        ldif = modlist.modifyModlist({'unicodePwd': 'tmp'}, attrs)
-        ldap_client.modify_s(dn, ldif)
+        with self._operation(write=True) as ldap_client:
+            ldif = modlist.modifyModlist({'unicodePwd': 'tmp'}, attrs)
+            ldap_client.modify_s(dn, ldif)
 
-        del(attrs['unicodePwd'])
-        attrs['UserAccountControl'] = self._modlist(
-            self._tobyte(NORMAL_ACCOUNT)
-        )
-        ldif = modlist.modifyModlist({'UserAccountControl': 'tmp'}, attrs)
-        ldap_client.modify_s(dn, ldif)
+            del(attrs['unicodePwd'])
+            attrs['UserAccountControl'] = self._modlist(
+                self._tobyte(NORMAL_ACCOUNT)
+            )
+            ldif = modlist.modifyModlist(
+                {'UserAccountControl': 'tmp'},
+                attrs,
+            )
+            ldap_client.modify_s(dn, ldif)
 
     def add_user(self, attrs):
         password = attrs['unicodePwd']
         del(attrs['unicodePwd'])
-        super(Backend, self).add_user(attrs)
-        self._set_password(attrs['cn'], password)
+        # add the user and set its password with the same connection
+        with self._operation(write=True):
+            super(Backend, self).add_user(attrs)
+            self._set_password(attrs['cn'], password)
 
     def set_attrs(self, username, attrs):
-        if 'unicodePwd' in attrs:
-            password = attrs['unicodePwd']
-            del(attrs['unicodePwd'])
-            userdn = self._get_user(self._byte_p2(username), NO_ATTR)
-            self._set_password(userdn, password, False)
-        super(Backend, self).set_attrs(username, attrs)
+        with self._operation(write=True):
+            if 'unicodePwd' in attrs:
+                password = attrs['unicodePwd']
+                del(attrs['unicodePwd'])
+                userdn = self._get_user(self._byte_p2(username), NO_ATTR)
+                self._set_password(userdn, password, False)
+            super(Backend, self).set_attrs(username, attrs)
 
     def add_to_groups(self, username, groups):
         ad_groups = self._build_groupdn(groups)
-        super(Backend, self).add_to_groups(username, ad_groups)
+        return super(Backend, self).add_to_groups(username, ad_groups)
 
     def del_from_groups(self, username, groups):
         ad_groups = self._build_groupdn(groups)
-        super(Backend, self).del_from_groups(username, ad_groups)
+        return super(Backend, self).del_from_groups(username, ad_groups)
+
+    def _group_bases(self):
+        return [self.groupdn, self.builtin]
+
+    def _group_name(self, dn):
+        # keep only the cn of the group
+        rdn = ldap.dn.str2dn(self._byte_p2(dn))[0]
+        return self._uni(rdn[0][1])
 
     def get_groups(self, username):
-        username = ldap.filter.escape_filter_chars(username)
-        userdn = self._get_user(self._byte_p2(username), NO_ATTR)
+        if self.membership_attr:
+            return self._membership_groups(self._get_membership(username))
 
-        searchfilter = self.group_filter_tmpl % {
-            'userdn': userdn,
-            'username': username
-        }
+        with self._operation():
+            userdn = self._get_user(self._byte_p2(username), NO_ATTR)
+            # the user is not in this backend
+            if userdn is None:
+                return []
+
+            searchfilter = self.group_filter.build({
+                'userdn': userdn,
+                'username': username
+            })
 
-        groups = self._search_group(searchfilter, self.groupdn)
-        groups = groups + self._search_group(searchfilter, self.builtin)
+            groups = self._search_group(searchfilter, self.groupdn)
+            groups = groups + self._search_group(searchfilter, self.builtin)
         ret = []
         self._logger(
             severity=logging.DEBUG,
@@ -265,16 +290,9 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
 
         binddn = username + '@' + self.domain
         if binddn is not None:
-            ldap_client = self._connect()
-            try:
-                ldap_client.simple_bind_s(
-                    self._byte_p2(binddn),
-                    self._byte_p2(password)
-                )
-            except ldap.INVALID_CREDENTIALS:
-                ldap_client.unbind_s()
-                return False
-            ldap_client.unbind_s()
-            return True
+            return self._user_bind(
+                self._byte_p2(binddn),
+                self._byte_p2(password)
+            )
         else:
             return False
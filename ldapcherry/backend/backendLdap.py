@@ -9,14 +9,28 @@ import cherrypy
 import ldap
 import ldap.modlist as modlist
 import ldap.filter
+from ldap.controls import SimplePagedResultsControl
+try:
+    from ldap.controls.sss import SSSRequestControl
+    from ldap.controls.vlv import VLVRequestControl, VLVResponseControl
+except ImportError:
+    # server side sorting and VLV need python-ldap >= 2.4.?
+    SSSRequestControl = None
 import logging
 import ldapcherry.backend
 import sys
 from ldapcherry.exceptions import UserDoesntExist, \
     GroupDoesntExist, \
     UserAlreadyExists
+from ldapcherry.lrucache import LRUCache
 import os
 import re
+import threading
+import time
+import random
+import functools
+from contextlib import closing, contextmanager
+from collections import OrderedDict
 if sys.version < '3':
     from sets import Set as set
 
@@ -43,12 +57,294 @@ class MultivaluedGroupAttr(Exception):
             ", cannot use it to set group" % {'attr': attr}
 
 
+class WrongFilterTemplate(Exception):
+    def __init__(self, param, tmpl, reason):
+        self.param = param
+        self.tmpl = tmpl
+        self.log = "invalid filter template '%(param)s'" \
+            " ('%(tmpl)s'): %(reason)s" % \
+            {'param': param, 'tmpl': tmpl, 'reason': reason}
+
+
+class WrongUri(Exception):
+    def __init__(self, param, uri, reason):
+        self.param = param
+        self.uri = uri
+        self.log = "invalid uri list '%(param)s'" \
+            " ('%(uri)s'): %(reason)s" % \
+            {'param': param, 'uri': uri, 'reason': reason}
+
+
 NO_ATTR = 0
 DISPLAYED_ATTRS = 1
 LISTED_ATTRS = 2
 ALL_ATTRS = 3
 
 
+# keys of a '%(key)s' format string
+FORMAT_KEY_RE = re.compile(r'%\(([^)]*)\)')
+# content of a simple filter item (RFC 4515):
+# <attr>[:dn][:<rule>]<operator><value>
+FILTER_ITEM_RE = re.compile(
+    r'^([a-zA-Z0-9][\w.;-]*)?(:dn)?(:[a-zA-Z0-9][\w.-]*)?'
+    r'(~=|>=|<=|:=|=)(\\[0-9a-fA-F]{2}|[^()\\])*$'
+)
+# group filter made of a single equality on the user dn or name,
+# ex: (member=%(userdn)s), (memberUid=%(username)s)
+# (<attr>, <prefix>, <key>, <suffix>)
+GROUP_MEMBER_FILTER_RE = re.compile(
+    r'^\(([a-zA-Z0-9][\w.;-]*)=([^()*\\%]*)%\((userdn|username)\)s'
+    r'([^()*\\%]*)\)$'
+)
+# item of the uri parameter: '<uri> [rw|ro]' (read/write if not tagged)
+URI_RE = re.compile(
+    r'\s*([a-zA-Z][\w+.-]*://[^\s,\[]*)\s*(?:\[(rw|ro)\])?\s*(,|$)'
+)
+
+
+def _filter_end(flt, pos):
+    """Check the syntax of the filter starting at 'pos'
+    and return the position just after it (raise ValueError if invalid)
+    """
+    if flt[pos:pos + 1] != '(':
+        raise ValueError(pos)
+    pos += 1
+    op = flt[pos:pos + 1]
+    if op in ('&', '|'):
+        pos += 1
+        while flt[pos:pos + 1] == '(':
+            pos = _filter_end(flt, pos)
+    elif op == '!':
+        pos = _filter_end(flt, pos + 1)
+    else:
+        end = flt.find(')', pos)
+        if end == -1 or not FILTER_ITEM_RE.match(flt[pos:end]):
+            raise ValueError(pos)
+        pos = end
+    if flt[pos:pos + 1] != ')':
+        raise ValueError(pos)
+    return pos + 1
+
+
+class FilterTemplate(object):
+    """Search filter template ('%(key)s' format string), checked
+    and compiled once, values are escaped when the filter is built
+    """
+
+    def __init__(self, param, tmpl, keys):
+        self.param = param
+        self.tmpl = tmpl
+        self.keys = FORMAT_KEY_RE.findall(tmpl)
+        for key in self.keys:
+            if key not in keys:
+                raise WrongFilterTemplate(
+                    param,
+                    tmpl,
+                    "unknown key '%(key)s', possible keys are [%(keys)s]" % {
+                        'key': key,
+                        'keys': ', '.join(keys),
+                    }
+                )
+        # build a filter with dummy values to check the syntax
+        try:
+            flt = self.build(dict((key, 'x') for key in self.keys))
+        except (TypeError, ValueError) as e:
+            raise WrongFilterTemplate(param, tmpl, 'bad format string')
+        try:
+            if _filter_end(flt, 0) != len(flt):
+                raise ValueError(len(flt))
+        except ValueError as e:
+            raise WrongFilterTemplate(param, tmpl, 'bad filter syntax')
+
+    def build(self, values):
+        """Build the filter, escaping the values"""
+        escaped = {}
+        for key in self.keys:
+            escaped[key] = ldap.filter.escape_filter_chars(values[key])
+        return self.tmpl % escaped
+
+
+class ConnectionPool(object):
+    """Bounded pool of ldap connections bound with the technical account
+
+    At most 'size' connections are kept open between two operations,
+    connections checked out above this limit are closed when released
+    (a busy worker never waits for a connection).
+    Connections idle for more than 'check_interval' seconds are checked
+    (whoami) before being reused.
+    """
+
+    def __init__(self, factory, size, check_interval):
+        self._factory = factory
+        self.size = size
+        self.check_interval = check_interval
+        self._idle = []
+        self._in_use = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'overflow': 0,
+            'discarded': 0,
+            'checks': 0,
+            'failed_checks': 0,
+        }
+
+    def _close(self, ldap_client):
+        try:
+            ldap_client.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _check(self, ldap_client):
+        """check that an idle connection is still usable"""
+        try:
+            ldap_client.whoami_s()
+        except ldap.LDAPError:
+            return False
+        return True
+
+    def get(self):
+        """check out a connection (reuse an idle one or open a new one)"""
+        while True:
+            with self._lock:
+                self._in_use += 1
+                if not self._idle:
+                    self._stats['created'] += 1
+                    break
+                ldap_client, last_used = self._idle.pop()
+                check = time.time() - last_used > self.check_interval
+                if check:
+                    self._stats['checks'] += 1
+            if not check or self._check(ldap_client):
+                with self._lock:
+                    self._stats['reused'] += 1
+                return ldap_client
+            # connection is dead (server restart, idle timeout...)
+            with self._lock:
+                self._in_use -= 1
+                self._stats['failed_checks'] += 1
+                self._stats['discarded'] += 1
+            self._close(ldap_client)
+        try:
+            return self._factory()
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+            raise
+
+    def put(self, ldap_client, discard=False):
+        """check in a connection"""
+        with self._lock:
+            self._in_use -= 1
+            if discard:
+                self._stats['discarded'] += 1
+            elif len(self._idle) < self.size:
+                self._idle.append((ldap_client, time.time()))
+                return
+            else:
+                self._stats['overflow'] += 1
+        self._close(ldap_client)
+
+    def flush(self):
+        """close all the idle connections"""
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+            self._stats['discarded'] += len(idle)
+        for ldap_client, last_used in idle:
+            self._close(ldap_client)
+
+    def stats(self):
+        """return the pool statistics"""
+        with self._lock:
+            ret = dict(self._stats)
+            ret['size'] = self.size
+            ret['idle'] = len(self._idle)
+            ret['in_use'] = self._in_use
+        return ret
+
+
+# errors meaning that an ldap server is not answering
+UNAVAILABLE = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT)
+
+
+class Server(object):
+    """One ldap server of a backend
+
+    It has its own pool of connections, an average latency
+    (exponentially weighted) used to prefer the fastest servers
+    and a circuit breaker: after 'threshold' consecutive failures
+    (or as soon as the server is down), it is not used for 'delay'
+    seconds, then it is tried again.
+    """
+
+    # weight of the last operation in the average latency
+    LATENCY_WEIGHT = 0.2
+
+    def __init__(self, uri, role, pool, threshold, delay):
+        self.uri = uri
+        self.role = role
+        self.pool = pool
+        self.threshold = threshold
+        self.delay = delay
+        self.latency = None
+        self.failures = 0
+        self.open_until = 0
+        self._lock = threading.Lock()
+
+    def available(self, now=None):
+        """check that the circuit breaker is closed
+        (or that the delay is over and the server can be tried again)
+        """
+        if now is None:
+            now = time.time()
+        return self.open_until <= now
+
+    def score(self):
+        """cost of sending an operation to this server
+        (servers never used come first)
+        """
+        stats = self.pool.stats()
+        return (self.latency or 0) * (stats['in_use'] + 1)
+
+    def success(self, duration=None):
+        """record an operation which succeeded (and its duration)"""
+        with self._lock:
+            self.failures = 0
+            self.open_until = 0
+            if duration is None:
+                return
+            if self.latency is None:
+                self.latency = duration
+            else:
+                self.latency += \
+                    (duration - self.latency) * self.LATENCY_WEIGHT
+
+    def failure(self, down=False):
+        """record a failure, returns True if the circuit breaker opens"""
+        with self._lock:
+            self.failures += 1
+            if down:
+                self.failures = max(self.failures, self.threshold)
+            if self.failures < self.threshold:
+                return False
+            self.open_until = time.time() + self.delay
+        # the idle connections are probably dead too
+        self.pool.flush()
+        return True
+
+    def stats(self):
+        """return the state and the pool statistics of the server"""
+        ret = self.pool.stats()
+        ret['uri'] = self.uri
+        ret['role'] = self.role
+        ret['latency'] = self.latency
+        ret['failures'] = self.failures
+        ret['available'] = self.available()
+        return ret
+
+
 class Backend(ldapcherry.backend.Backend):
 
     def __init__(self, config, logger, name, attrslist, key):
@@ -65,12 +361,16 @@ class Backend(ldapcherry.backend.Backend):
         self.starttls = self.get_param('starttls', 'off')
         self.uri = self.get_param('uri')
         self.timeout = self.get_param('timeout', 1)
+        self.page_size = int(self.get_param('page_size', 0))
         self.userdn = self.get_param('userdn')
         self.groupdn = self.get_param('groupdn')
         self.user_filter_tmpl = self.get_param('user_filter_tmpl')
         self.group_filter_tmpl = self.get_param('group_filter_tmpl')
         self.search_filter_tmpl = self.get_param('search_filter_tmpl')
         self.dn_user_attr = self.get_param('dn_user_attr')
+        # user attribute listing the groups of the user
+        # (memberOf, isMemberOf), groups are searched if not set
+        self.membership_attr = self.get_param('membership_attr', False)
         self.objectclasses = []
         self.key = key
         # objectclasses parameter is a coma separated list in configuration
@@ -90,6 +390,105 @@ class Backend(ldapcherry.backend.Backend):
         self.attrlist = []
         for a in attrslist:
             self.attrlist.append(self._byte_p2(a))
+        # restricted by set_displayed_attrs()
+        self.displayed_attrlist = self.attrlist
+
+        self._init_templates()
+        self._init_options()
+        self._init_pool()
+        self._init_dn_cache()
+
+    def _init_templates(self):
+        """Compile the search filter and user dn templates"""
+        self.user_filter = FilterTemplate(
+            self.backend_name + '.user_filter_tmpl',
+            self.user_filter_tmpl,
+            ['username'],
+        )
+        self.group_filter = FilterTemplate(
+            self.backend_name + '.group_filter_tmpl',
+            self.group_filter_tmpl,
+            ['userdn', 'username'],
+        )
+        self.search_filter = FilterTemplate(
+            self.backend_name + '.search_filter_tmpl',
+            self.search_filter_tmpl,
+            ['searchstring'],
+        )
+        # dn of new users is <user_dn_prefix><escaped value><user_dn_suffix>
+        self.user_dn_prefix = self._byte_p2(self.dn_user_attr + '=')
+        self.user_dn_suffix = self._byte_p2(',' + self.userdn)
+
+    def _init_pool(self):
+        """Initialize the ldap servers and their pools of connections
+        (by default, one connection per cherrypy thread and per server)
+        """
+        self.pool_size = int(self.get_param(
+            'pool_size',
+            cherrypy.config.get('server.thread_pool', 10)
+        ))
+        self.pool_check_interval = int(
+            self.get_param('pool_check_interval', 30)
+        )
+        self.breaker_threshold = int(self.get_param('breaker_threshold', 3))
+        self.breaker_delay = int(self.get_param('breaker_delay', 30))
+        self.servers = []
+        for uri, role in self._parse_uri(self.uri):
+            pool = ConnectionPool(
+                functools.partial(self._open, uri),
+                self.pool_size,
+                self.pool_check_interval,
+            )
+            self.servers.append(Server(
+                uri,
+                role,
+                pool,
+                self.breaker_threshold,
+                self.breaker_delay,
+            ))
+        # connection of the operation in progress (one per thread)
+        self._local = threading.local()
+
+    def _init_dn_cache(self):
+        """Initialize the cache of the user dns
+        (username -> dn, disabled if dn_cache_ttl is 0)
+        """
+        dn_cache_ttl = int(self.get_param('dn_cache_ttl', 60))
+        if dn_cache_ttl:
+            self.dn_cache = LRUCache(
+                int(self.get_param('dn_cache_size', 1000)),
+                dn_cache_ttl,
+            )
+        else:
+            self.dn_cache = None
+
+    def _invalidate_dn(self, username):
+        """Remove a user from the dn cache"""
+        if self.dn_cache is not None:
+            self.dn_cache.invalidate(self._uni(username))
+
+    def _parse_uri(self, uri):
+        """Parse the uri parameter, a list of '<uri> [rw|ro]'
+        returns the list of (<uri>, <role>)
+        """
+        param = self.backend_name + '.uri'
+        if isinstance(uri, list):
+            uri = ', '.join(uri)
+        # keep a readable version for the logs
+        self.uri = uri
+        ret = []
+        pos = 0
+        while pos < len(uri):
+            match = URI_RE.match(uri, pos)
+            if match is None:
+                raise WrongUri(param, uri, "syntax error at '%s'" % uri[pos:])
+            ret.append((match.group(1), match.group(2) or 'rw'))
+            pos = match.end()
+        if not ret:
+            raise WrongUri(param, uri, "no uri")
+        if 'rw' not in [role for u, role in ret]:
+            raise WrongUri(param, uri, "no read/write uri")
+        return ret
 
     # exception handler (mainly to log something meaningful)
     def _exception_handler(self, e):
@@ -163,18 +562,26 @@ class Backend(ldapcherry.backend.Backend):
         """Extract the keys of a format string
         (the 'stuff' in '%(stuff)s'
         """
+        return FORMAT_KEY_RE.findall(fmt_string)
 
-        class AccessSaver:
-            def __init__(self):
-                self.keys = []
-
-            def __getitem__(self, key):
-                self.keys.append(key)
-
-        a = AccessSaver()
-        fmt_string % a
+    def _projection(self, attrs):
+        """Build the list of attributes to recover in a search
+        (only the dn if attrs is empty)
+        """
+        attrlist = []
+        for a in attrs:
+            attrlist.append(self._byte_p2(a))
+        if not attrlist:
+            attrlist = ['1.1']
+        return attrlist
 
-        return a.keys
+    def _group_attrs_projection(self):
+        """List of user attributes needed to fill
+        the group_attr templates
+        """
+        return self._projection(
+            [a for a in self.group_attrs_keys if a != 'dn']
+        )
 
     def _normalize_group_attrs(self, attrs):
         """Normalize the attributes used to set groups
@@ -191,45 +598,42 @@ class Backend(ldapcherry.backend.Backend):
             if type(attrs[key]) is list and len(attrs[key]) != 1:
                 raise MultivaluedGroupAttr(key)
 
-    def _connect(self):
-        """Initialize an ldap client"""
-        ldap_client = ldap.initialize(self.uri)
-        ldap.set_option(ldap.OPT_REFERRALS, 0)
-        ldap.set_option(ldap.OPT_TIMEOUT, self.timeout)
-        if self.starttls == 'on':
-            ldap.set_option(ldap.OPT_X_TLS_DEMAND, True)
-        else:
-            ldap.set_option(ldap.OPT_X_TLS_DEMAND, False)
+    def _init_options(self):
+        """Compute the options of the ldap connections once
+        (they are set on each connection, not globally, so backends
+        with different tls settings don't interfere)
+        """
+        self.ldap_options = [
+            (ldap.OPT_REFERRALS, 0),
+            (ldap.OPT_TIMEOUT, self.timeout),
+        ]
         # set the CA file if declared and if necessary
         if self.ca and self.checkcert == 'on':
             # check if the CA file actually exists
-            if os.path.isfile(self.ca):
-                ldap.set_option(ldap.OPT_X_TLS_CACERTFILE, self.ca)
-            else:
+            if not os.path.isfile(self.ca):
                 raise CaFileDontExist(self.ca)
+            self.ldap_options.append((ldap.OPT_X_TLS_CACERTFILE, self.ca))
         if self.checkcert == 'off':
-            # this is dark magic
-            # remove any of these two lines and it doesn't work
-            ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
-            ldap_client.set_option(
-                ldap.OPT_X_TLS_REQUIRE_CERT,
-                ldap.OPT_X_TLS_NEVER
-                )
+            self.ldap_options.append(
+                (ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
+            )
         else:
-            # this is even darker magic
-            ldap_client.set_option(
-                ldap.OPT_X_TLS_REQUIRE_CERT,
-                ldap.OPT_X_TLS_DEMAND
-                )
-            # it doesn't make sense to set it to never
-            # (== don't check certifate)
-            # but it only works with this option...
-            # ... and it checks the certificat
-            # (I've lost my sanity over this)
-            ldap.set_option(
-                ldap.OPT_X_TLS_REQUIRE_CERT,
-                ldap.OPT_X_TLS_NEVER
-                )
+            self.ldap_options.append(
+                (ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_DEMAND)
+            )
+        # the tls options are only taken into account
+        # in a new tls context (it must be the last option)
+        self.ldap_options.append((ldap.OPT_X_TLS_NEWCTX, 0))
+
+    def _connect(self, uri=None):
+        """Initialize an ldap client
+        (on the first server if uri is not specified)
+        """
+        if uri is None:
+            uri = self.servers[0].uri
+        ldap_client = ldap.initialize(uri)
+        for option, value in self.ldap_options:
+            ldap_client.set_option(option, value)
         if self.starttls == 'on':
             try:
                 ldap_client.start_tls_s()
@@ -237,27 +641,223 @@ class Backend(ldapcherry.backend.Backend):
                 self._exception_handler(e)
         return ldap_client
 
-    def _bind(self):
-        """bind to the ldap with the technical account"""
-        ldap_client = self._connect()
+    def _open(self, uri):
+        """open a new connection bound with the technical account"""
+        ldap_client = self._connect(uri)
         try:
             ldap_client.simple_bind_s(self.binddn, self.bindpassword)
+        except UNAVAILABLE:
+            # handled by the failover
+            ldap_client.unbind_s()
+            raise
         except Exception as e:
             ldap_client.unbind_s()
             self._exception_handler(e)
         return ldap_client
 
-    def _search(self, searchfilter, attrs, basedn):
-        """Generic search"""
+    def _candidates(self, write=False):
+        """servers to use for an operation, by order of preference
+
+        Writes go to the read/write servers in the configuration order.
+        Reads go to the least loaded and fastest read only servers
+        (read/write servers if there is none), then to the others.
+        Servers with an open circuit breaker come last.
+        """
+        rw = [s for s in self.servers if s.role == 'rw']
+        ro = [s for s in self.servers if s.role == 'ro']
+        if write:
+            servers = rw
+        else:
+            if not ro:
+                ro, rw = rw, []
+            # random to spread the load between equivalent servers
+            servers = sorted(ro, key=lambda s: (s.score(), random.random()))
+            servers += sorted(rw, key=lambda s: (s.score(), random.random()))
+        now = time.time()
+        return [s for s in servers if s.available(now)] + \
+            [s for s in servers if not s.available(now)]
+
+    def _failure(self, server, e):
+        """record the failure of a server"""
+        if server.failure(isinstance(e, (ldap.SERVER_DOWN,
+                                         ldap.CONNECT_ERROR))):
+            self._logger(
+                severity=logging.WARNING,
+                msg="%(backend)s: ldap server '%(uri)s' disabled"
+                    " for %(delay)s seconds after %(failures)s"
+                    " failure(s), last error: %(error)s" % {
+                        'backend': self.backend_name,
+                        'uri': server.uri,
+                        'delay': server.delay,
+                        'failures': server.failures,
+                        'error': type(e).__name__,
+                    }
+            )
+
+    def _bind(self, write=False):
+        """get a connection bound with the technical account
+        from the pool of the best available server
+        (must be given back with _unbind)
+        returns (<server>, <connection>)
+        """
+        servers = self._candidates(write)
+        for server in servers:
+            try:
+                return (server, server.pool.get())
+            except UNAVAILABLE as e:
+                self._failure(server, e)
+                # no more server to try
+                if server is servers[-1]:
+                    self._exception_handler(e)
+
+    def _unbind(self, server, ldap_client, e=None, duration=None):
+        """give back a connection to the pool of its server
+        if the operation failed because the server went away,
+        the connection and the other idle connections are dropped
+        """
+        if isinstance(e, UNAVAILABLE):
+            server.pool.put(ldap_client, discard=True)
+            server.pool.flush()
+            self._failure(server, e)
+        else:
+            server.pool.put(ldap_client)
+            server.success(duration)
+
+    def _in_operation(self):
+        """check if the current thread is inside an operation"""
+        return getattr(self._local, 'operation', None) is not None
+
+    @contextmanager
+    def _operation(self, write=False):
+        """connection shared by all the requests of a backend operation
+
+        The first (outermost) call takes a connection from the pool
+        and gives it back at the end of the operation, nested calls
+        in the same thread (_search, _get_user...) reuse it.
+        Write operations (write=True) are sent to a read/write server,
+        a write nested in a read operation uses its own connection.
+        """
+        current = getattr(self._local, 'operation', None)
+        if current is not None and (current[2] or not write):
+            yield current[0]
+            return
+        server, ldap_client = self._bind(write)
+        self._local.operation = (ldap_client, server, write)
+        start = time.time()
+        error = None
+        try:
+            yield ldap_client
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # also done if a generator holding the operation
+            # is closed before its end (GeneratorExit)
+            self._local.operation = current
+            if error is not None:
+                self._unbind(server, ldap_client, error)
+            # the latency is only tracked for reads, to choose
+            # between the servers
+            elif write:
+                self._unbind(server, ldap_client)
+            else:
+                self._unbind(
+                    server,
+                    ldap_client,
+                    duration=time.time() - start
+                    )
+
+    def get_pool_stats(self):
+        """return the statistics of the connection pools
+        (sum of the statistics of all the servers)
+        """
+        ret = {}
+        for server in self.servers:
+            stats = server.pool.stats()
+            for key in stats:
+                ret[key] = ret.get(key, 0) + stats[key]
+        return ret
+
+    def get_servers_stats(self):
+        """return the state and statistics of each ldap server"""
+        return [server.stats() for server in self.servers]
+
+    def _user_bind(self, binddn, password):
+        """Check the password of a user by binding with his account
+        (on the best available server)
+        """
+        servers = self._candidates()
+        for server in servers:
+            ldap_client = None
+            try:
+                ldap_client = self._connect(server.uri)
+                ldap_client.simple_bind_s(binddn, password)
+                return True
+            except ldap.INVALID_CREDENTIALS:
+                return False
+            except UNAVAILABLE as e:
+                self._failure(server, e)
+                if server is servers[-1]:
+                    self._exception_handler(e)
+            finally:
+                if ldap_client is not None:
+                    try:
+                        ldap_client.unbind_s()
+                    except ldap.LDAPError:
+                        pass
+
+    def _search_pages(self, searchfilter, attrlist, basedn):
+        """Run a search, yielding the raw results page by page
+        (RFC 2696 paged results if page_size is set, in one go otherwise)
+        """
+        with self._operation() as ldap_client:
+            if not self.page_size:
+                yield ldap_client.search_s(
+                    basedn,
+                    ldap.SCOPE_SUBTREE,
+                    searchfilter,
+                    attrlist=attrlist
+                    )
+                return
+            # not critical: if the server doesn't support paging,
+            # everything is returned in the first page
+            page_ctrl = SimplePagedResultsControl(
+                False,
+                size=self.page_size,
+                cookie='',
+                )
+            while True:
+                msgid = ldap_client.search_ext(
+                    basedn,
+                    ldap.SCOPE_SUBTREE,
+                    searchfilter,
+                    attrlist=attrlist,
+                    serverctrls=[page_ctrl]
+                    )
+                rtype, rdata, rmsgid, serverctrls = \
+                    ldap_client.result3(msgid)
+                yield rdata
+                page_ctrl.cookie = None
+                for ctrl in serverctrls:
+                    if ctrl.controlType == page_ctrl.controlType:
+                        page_ctrl.cookie = ctrl.cookie
+                if not page_ctrl.cookie:
+                    return
+
+    def _iter_search(self, searchfilter, attrs, basedn):
+        """Generic search, yields the entries as they arrive"""
         if attrs == NO_ATTR:
-            attrlist = []
+            # '1.1' is the "no attributes" attribute list (RFC 4511)
+            attrlist = ['1.1']
         elif attrs == DISPLAYED_ATTRS:
-            # fix me later (to much attributes)
-            attrlist = self.attrlist
+            attrlist = self.displayed_attrlist
         elif attrs == LISTED_ATTRS:
             attrlist = self.attrlist
         elif attrs == ALL_ATTRS:
             attrlist = None
+        elif isinstance(attrs, list):
+            # explicit list of attributes
+            attrlist = attrs
         else:
             attrlist = None
 
@@ -272,51 +872,75 @@ class Backend(ldapcherry.backend.Backend):
         )
 
         # bind and search the ldap
-        ldap_client = self._bind()
-        try:
-            r = ldap_client.search_s(
-                basedn,
-                ldap.SCOPE_SUBTREE,
-                searchfilter,
-                attrlist=attrlist
-                )
-        except Exception as e:
-            ldap_client.unbind_s()
-            self._exception_handler(e)
+        # (if a pooled connection was closed by the server,
+        # retry once with a fresh connection, unless the search
+        # is part of a larger operation or entries were already
+        # returned)
+        for retry in (not self._in_operation(), False):
+            try:
+                # closing: the connection is given back even if
+                # the caller stops iterating before the end
+                with closing(self._search_pages(
+                        searchfilter, attrlist, basedn)) as pages:
+                    for page in pages:
+                        retry = False
+                        for entry in page:
+                            # skip search references
+                            if entry[0] is None:
+                                continue
+                            yield self._decode_entry(entry)
+            except ldap.SERVER_DOWN as e:
+                if retry:
+                    continue
+                self._exception_handler(e)
+            except Exception as e:
+                self._exception_handler(e)
+            break
 
-        ldap_client.unbind_s()
+    def _decode_entry(self, entry):
+        """python-ldap doesn't know utf-8,
+        it treates everything as bytes.
+        So it's necessary to reencode
+        it's output in utf-8.
+        """
+        uni_dn = self._uni(entry[0])
+        uni_attrs = {}
+        for attr in entry[1]:
+            if type(entry[1][attr]) is list:
+                tmp = []
+                for value in entry[1][attr]:
+                    tmp.append(self._uni(value))
+            else:
+                tmp = self._uni(entry[1][attr])
+            uni_attrs[self._uni(attr)] = tmp
+        return (uni_dn, uni_attrs)
 
-        # python-ldap doesn't know utf-8,
-        # it treates everything as bytes.
-        # So it's necessary to reencode
-        # it's output in utf-8.
-        ret = []
-        for entry in r:
-            uni_dn = self._uni(entry[0])
-            uni_attrs = {}
-            for attr in entry[1]:
-                if type(entry[1][attr]) is list:
-                    tmp = []
-                    for value in entry[1][attr]:
-                        tmp.append(self._uni(value))
-                else:
-                    tmp = self._uni(entry[1][attr])
-                uni_attrs[self._uni(attr)] = tmp
-            ret.append((uni_dn, uni_attrs))
-        return ret
+    def _search(self, searchfilter, attrs, basedn):
+        """Generic search"""
+        return list(self._iter_search(searchfilter, attrs, basedn))
 
     def _get_user(self, username, attrs=ALL_ATTRS):
-        """Get a user from the ldap"""
+        """Get a user from the ldap
+        (the dn of the users found is cached, NO_ATTR lookups
+        are answered from the cache)
+        """
+        key = self._uni(username)
+        if attrs == NO_ATTR and self.dn_cache is not None:
+            dn = self.dn_cache.get(key)
+            if dn is not None:
+                return dn
 
-        username = ldap.filter.escape_filter_chars(username)
-        user_filter = self.user_filter_tmpl % {
-            'username': self._uni(username)
-        }
+        user_filter = self.user_filter.build({
+            'username': key
+        })
         r = self._search(self._byte_p2(user_filter), attrs, self.userdn)
 
         if len(r) == 0:
             return None
 
+        if self.dn_cache is not None:
+            self.dn_cache.set(key, r[0][0])
+
         # if NO_ATTR, only return the DN
         if attrs == NO_ATTR:
             dn_entry = r[0][0]
@@ -401,17 +1025,10 @@ class Backend(ldapcherry.backend.Backend):
 
         binddn = self._get_user(self._byte_p2(username), NO_ATTR)
         if binddn is not None:
-            ldap_client = self._connect()
-            try:
-                ldap_client.simple_bind_s(
-                        self._byte_p2(binddn),
-                        self._byte_p2(password)
-                        )
-            except ldap.INVALID_CREDENTIALS:
-                ldap_client.unbind_s()
-                return False
-            ldap_client.unbind_s()
-            return True
+            return self._user_bind(
+                self._byte_p2(binddn),
+                self._byte_p2(password)
+            )
         else:
             return False
 
@@ -427,199 +1044,245 @@ class Backend(ldapcherry.backend.Backend):
 
     def add_user(self, attrs):
         """add a user"""
-        ldap_client = self._bind()
-        # encoding crap
-        attrs_srt = self.attrs_pretreatment(attrs)
-
-        attrs_srt[self._byte_p2('objectClass')] = self.objectclasses
-        # construct is DN
-        dn = \
-            self._byte_p2(self.dn_user_attr) + \
-            self._byte_p2('=') + \
-            self._byte_p2(ldap.dn.escape_dn_chars(
-                        attrs[self.dn_user_attr]
-                    )
-                ) + \
-            self._byte_p2(',') + \
-            self._byte_p2(self.userdn)
-        # gen the ldif first add_s and add the user
-        ldif = modlist.addModlist(attrs_srt)
-        try:
-            ldap_client.add_s(dn, ldif)
-        except ldap.ALREADY_EXISTS as e:
-            raise UserAlreadyExists(attrs[self.key], self.backend_name)
-        except Exception as e:
-            ldap_client.unbind_s()
-            self._exception_handler(e)
-        ldap_client.unbind_s()
+        with self._operation(write=True) as ldap_client:
+            # encoding crap
+            attrs_srt = self.attrs_pretreatment(attrs)
+
+            attrs_srt[self._byte_p2('objectClass')] = self.objectclasses
+            # construct is DN
+            dn = \
+                self.user_dn_prefix + \
+                self._byte_p2(ldap.dn.escape_dn_chars(
+                            attrs[self.dn_user_attr]
+                        )
+                    ) + \
+                self.user_dn_suffix
+            # gen the ldif first add_s and add the user
+            ldif = modlist.addModlist(attrs_srt)
+            try:
+                ldap_client.add_s(dn, ldif)
+            except ldap.ALREADY_EXISTS as e:
+                raise UserAlreadyExists(attrs[self.key], self.backend_name)
+            except Exception as e:
+                self._exception_handler(e)
 
     def del_user(self, username):
         """delete a user"""
-        ldap_client = self._bind()
-        # recover the user dn
-        dn = self._byte_p2(self._get_user(self._byte_p2(username), NO_ATTR))
-        # delete
-        if dn is not None:
-            ldap_client.delete_s(dn)
-        else:
-            ldap_client.unbind_s()
-            raise UserDoesntExist(username, self.backend_name)
-        ldap_client.unbind_s()
+        with self._operation(write=True) as ldap_client:
+            # recover the user dn
+            dn = self._byte_p2(
+                self._get_user(self._byte_p2(username), NO_ATTR)
+            )
+            # delete
+            if dn is not None:
+                ldap_client.delete_s(dn)
+                self._invalidate_dn(username)
+            else:
+                raise UserDoesntExist(username, self.backend_name)
 
     def set_attrs(self, username, attrs):
         """ set user attributes"""
-        ldap_client = self._bind()
-        tmp = self._get_user(self._byte_p2(username), ALL_ATTRS)
-        if tmp is None:
-            raise UserDoesntExist(username, self.backend_name)
-        dn = self._byte_p2(tmp[0])
-        old_attrs = tmp[1]
-        for attr in attrs:
-            bcontent = self._byte_p2(attrs[attr])
-            battr = self._byte_p2(attr)
-            new = {battr: self._modlist(self._byte_p3(bcontent))}
-            # if attr is dn entry, use rename
-            if attr.lower() == self.dn_user_attr.lower():
-                ldap_client.rename_s(
-                    dn,
-                    ldap.dn.dn2str([[(battr, bcontent, 1)]])
-                    )
-                dn = ldap.dn.dn2str(
-                    [[(battr, bcontent, 1)]] + ldap.dn.str2dn(dn)[1:]
-                    )
-            else:
-                # if attr is already set, replace the value
-                # (see dict old passed to modifyModlist)
-                if attr in old_attrs:
-                    if type(old_attrs[attr]) is list:
-                        tmp = []
-                        for value in old_attrs[attr]:
-                            tmp.append(self._byte_p2(value))
-                        bold_value = tmp
-                    else:
-                        bold_value = self._modlist(
-                            self._byte_p3(old_attrs[attr])
+        with self._operation(write=True) as ldap_client:
+            # only the modified attributes are needed
+            tmp = self._get_user(
+                self._byte_p2(username),
+                self._projection(attrs)
+            )
+            if tmp is None:
+                raise UserDoesntExist(username, self.backend_name)
+            dn = self._byte_p2(tmp[0])
+            old_attrs = tmp[1]
+            for attr in attrs:
+                bcontent = self._byte_p2(attrs[attr])
+                battr = self._byte_p2(attr)
+                new = {battr: self._modlist(self._byte_p3(bcontent))}
+                # if attr is dn entry, use rename
+                if attr.lower() == self.dn_user_attr.lower():
+                    ldap_client.rename_s(
+                        dn,
+                        ldap.dn.dn2str([[(battr, bcontent, 1)]])
+                        )
+                    dn = ldap.dn.dn2str(
+                        [[(battr, bcontent, 1)]] +
+                        ldap.dn.str2dn(dn)[1:]
                         )
-                    old = {battr: bold_value}
-                # attribute is not set, just add it
+                    self._invalidate_dn(username)
                 else:
-                    old = {}
-                ldif = modlist.modifyModlist(old, new)
-                if ldif:
-                    try:
-                        ldap_client.modify_s(dn, ldif)
-                    except Exception as e:
-                        ldap_client.unbind_s()
-                        self._exception_handler(e)
+                    # if attr is already set, replace the value
+                    # (see dict old passed to modifyModlist)
+                    if attr in old_attrs:
+                        if type(old_attrs[attr]) is list:
+                            tmp = []
+                            for value in old_attrs[attr]:
+                                tmp.append(self._byte_p2(value))
+                            bold_value = tmp
+                        else:
+                            bold_value = self._modlist(
+                                self._byte_p3(old_attrs[attr])
+                            )
+                        old = {battr: bold_value}
+                    # attribute is not set, just add it
+                    else:
+                        old = {}
+                    ldif = modlist.modifyModlist(old, new)
+                    if ldif:
+                        try:
+                            ldap_client.modify_s(dn, ldif)
+                        except Exception as e:
+                            self._exception_handler(e)
+                        # the user is not found with this name anymore
+                        if attr.lower() == self.key.lower():
+                            self._invalidate_dn(username)
 
-        ldap_client.unbind_s()
+    def _drain(self, ldap_client, msgids):
+        """Read and ignore the answers of requests sent
+        without waiting for them
+        """
+        for msgid in msgids:
+            try:
+                ldap_client.result3(msgid)
+            except ldap.LDAPError:
+                pass
 
-    def add_to_groups(self, username, groups):
-        ldap_client = self._bind()
-        # recover dn of the user and his attributes
-        tmp = self._get_user(self._byte_p2(username), ALL_ATTRS)
-        dn = tmp[0]
-        attrs = tmp[1]
-        attrs['dn'] = dn
-        self._normalize_group_attrs(attrs)
-        dn = self._byte_p2(tmp[0])
-        # add user to all groups
-        for group in groups:
-            group = self._byte_p2(group)
-            # iterate on group membership attributes
-            for attr in self.group_attrs:
-                # fill the content template
-                content = self._byte_p2(self.group_attrs[attr] % attrs)
-                self._logger(
-                    severity=logging.DEBUG,
-                    msg="%(backend)s: adding user '%(user)s'"
-                        " with dn '%(dn)s' to group '%(group)s' by"
-                        " setting '%(attr)s' to '%(content)s'" % {
-                            'user': username,
-                            'dn': self._uni(dn),
-                            'group': self._uni(group),
-                            'attr': attr,
-                            'content': self._uni(content),
-                            'backend': self.backend_name
-                            }
-                )
-                ldif = modlist.modifyModlist(
-                        {},
-                        {attr: self._modlist(self._byte_p3(content))}
-                       )
+    def _modify_groups(self, username, groups, mod):
+        """Add (mod=ldap.MOD_ADD) or remove (mod=ldap.MOD_DELETE)
+        a user to/from groups
+
+        All the modifications are sent without waiting for the answers,
+        then the answers are collected in a dict:
+        {<group>: {<group_attr>: <status>}}, with status in
+        'added', 'removed', 'already_member', 'not_member'
+        or 'no_such_group'
+        """
+        with self._operation(write=True) as ldap_client:
+            # recover dn of the user and his attributes
+            tmp = self._get_user(
+                self._byte_p2(username),
+                self._group_attrs_projection()
+            )
+            if tmp is None:
+                raise UserDoesntExist(username, self.backend_name)
+            dn = tmp[0]
+            attrs = tmp[1]
+            attrs['dn'] = dn
+            self._normalize_group_attrs(attrs)
+            if mod == ldap.MOD_ADD:
+                done = 'added'
+                action = 'adding user'
+            else:
+                done = 'removed'
+                action = 'removing user'
+            # send all the modifications
+            pending = []
+            try:
+                for group in groups:
+                    bgroup = self._byte_p2(group)
+                    # iterate on group membership attributes
+                    for attr in self.group_attrs:
+                        # fill the content template
+                        content = self._byte_p2(
+                            self.group_attrs[attr] % attrs
+                        )
+                        self._logger(
+                            severity=logging.DEBUG,
+                            msg="%(backend)s: %(action)s '%(user)s'"
+                                " with dn '%(dn)s' in group '%(group)s' by"
+                                " modifying '%(attr)s' with '%(content)s'"
+                                % {
+                                    'action': action,
+                                    'user': username,
+                                    'dn': dn,
+                                    'group': group,
+                                    'attr': attr,
+                                    'content': self._uni(content),
+                                    'backend': self.backend_name
+                                    }
+                        )
+                        if mod == ldap.MOD_ADD:
+                            ldif = modlist.modifyModlist(
+                                {},
+                                {attr: self._modlist(self._byte_p3(content))}
+                            )
+                        else:
+                            ldif = [
+                                (ldap.MOD_DELETE, attr, self._byte_p3(content))
+                            ]
+                        pending.append(
+                            (group, attr, ldap_client.modify_ext(bgroup, ldif))
+                        )
+            except Exception as e:
+                # the connection goes back to the pool, the answers
+                # of the modifications already sent must be read
+                self._drain(ldap_client, [p[2] for p in pending])
+                self._exception_handler(e)
+
+            # collect the answers
+            results = {}
+            error = None
+            for group, attr, msgid in pending:
                 try:
-                    ldap_client.modify_s(group, ldif)
-                # if already member, not a big deal, just log it and continue
-                except (ldap.TYPE_OR_VALUE_EXISTS, ldap.ALREADY_EXISTS) as e:
-                    self._logger(
-                        severity=logging.INFO,
-                        msg="%(backend)s: user '%(user)s'"
-                            " already member of group '%(group)s'"
-                            " (attribute '%(attr)s')" % {
-                                'user': username,
-                                'group': self._uni(group),
-                                'attr': attr,
-                                'backend': self.backend_name
-                                }
-                    )
+                    ldap_client.result3(msgid)
+                    status = done
+                # if already member (or not member), not a big deal
+                except (ldap.TYPE_OR_VALUE_EXISTS,
+                        ldap.ALREADY_EXISTS) as e:
+                    status = 'already_member'
+                except ldap.NO_SUCH_ATTRIBUTE as e:
+                    status = 'not_member'
                 except ldap.NO_SUCH_OBJECT as e:
-                    raise GroupDoesntExist(group, self.backend_name)
+                    status = 'no_such_group'
                 except Exception as e:
-                    ldap_client.unbind_s()
-                    self._exception_handler(e)
-        ldap_client.unbind_s()
-
-    def del_from_groups(self, username, groups):
-        """Delete user from groups"""
-        # it follows the same logic than add_to_groups
-        # but with MOD_DELETE
-        ldap_client = self._bind()
-        tmp = self._get_user(self._byte_p2(username), ALL_ATTRS)
-        if tmp is None:
-            raise UserDoesntExist(username, self.backend_name)
-        dn = tmp[0]
-        attrs = tmp[1]
-        attrs['dn'] = dn
-        self._normalize_group_attrs(attrs)
-        dn = self._byte_p2(tmp[0])
-        for group in groups:
-            group = self._byte_p2(group)
-            for attr in self.group_attrs:
-                content = self._byte_p2(self.group_attrs[attr] % attrs)
-                ldif = [(ldap.MOD_DELETE, attr, self._byte_p3(content))]
+                    status = 'error'
+                    if error is None:
+                        error = e
+                if group not in results:
+                    results[group] = {}
+                results[group][attr] = status
+            if error is not None:
                 try:
-                    ldap_client.modify_s(group, ldif)
-                except ldap.NO_SUCH_ATTRIBUTE as e:
-                    self._logger(
-                        severity=logging.INFO,
-                        msg="%(backend)s: user '%(user)s'"
-                        " wasn't member of group '%(group)s'"
-                        " (attribute '%(attr)s')" % {
-                            'user': username,
-                            'group': self._uni(group),
-                            'attr': attr,
-                            'backend': self.backend_name
-                            }
-                    )
+                    raise error
                 except Exception as e:
-                    ldap_client.unbind_s()
                     self._exception_handler(e)
-        ldap_client.unbind_s()
 
-    def search(self, searchstring):
-        """Search users"""
-        # escape special char to avoid injection
-        searchstring = ldap.filter.escape_filter_chars(
-            self._byte_p2(searchstring)
+        self._logger(
+            severity=logging.DEBUG,
+            msg="%(backend)s: group modifications of user '%(user)s':"
+                " %(results)s" % {
+                    'user': username,
+                    'results': str(results),
+                    'backend': self.backend_name
+                    }
         )
-        # fill the search string template
-        searchfilter = self.search_filter_tmpl % {
-            'searchstring': searchstring
-        }
+        for group in results:
+            if 'no_such_group' in results[group].values():
+                raise GroupDoesntExist(group, self.backend_name)
+        return results
 
-        ret = {}
-        # search an process the result a little
-        for u in self._search(searchfilter, DISPLAYED_ATTRS, self.userdn):
+    def add_to_groups(self, username, groups):
+        """Add user to groups, returns the status of each modification
+        {<group>: {<group_attr>: 'added'|'already_member'|'no_such_group'}}
+        """
+        return self._modify_groups(username, groups, ldap.MOD_ADD)
+
+    def del_from_groups(self, username, groups):
+        """Delete user from groups, returns the status of each modification
+        {<group>: {<group_attr>: 'removed'|'not_member'|'no_such_group'}}
+        """
+        return self._modify_groups(username, groups, ldap.MOD_DELETE)
+
+    def _search_filter(self, searchstring):
+        """Build the user search filter from a search string"""
+        # (special chars are escaped to avoid injection)
+        return self._byte_p2(self.search_filter.build({
+            'searchstring': self._uni(searchstring)
+        }))
+
+    def _search_result(self, entries):
+        """Build the {<key>: {<attr>: <value>}} result of a user search
+        (in the order of the entries)
+        """
+        ret = OrderedDict()
+        for u in entries:
             attrs = {}
             attrs_tmp = u[1]
             for attr in attrs_tmp:
@@ -633,10 +1296,100 @@ class Backend(ldapcherry.backend.Backend):
                 ret[attrs[self.key]] = attrs
         return ret
 
+    def set_displayed_attrs(self, attrslist):
+        """Restrict user searches to the displayed attributes
+        (and the key, used to index the results)
+        """
+        self.displayed_attrlist = self._projection(
+            sorted(set(attrslist) | set([self.key]))
+        )
+
+    def search(self, searchstring):
+        """Search users"""
+        searchfilter = self._search_filter(searchstring)
+        # search an process the result a little
+        # (entries are consumed page by page)
+        return self._search_result(
+            self._iter_search(searchfilter, DISPLAYED_ATTRS, self.userdn)
+        )
+
+    def search_sorted(self, searchstring, sort, offset=0, limit=None):
+        """Search users, sorted and windowed by the server
+        (server side sorting + virtual list view), falls back
+        to sorting in ldapcherry if the server doesn't support it
+        """
+        if SSSRequestControl is None or not limit:
+            return super(Backend, self).search_sorted(
+                searchstring, sort, offset, limit
+            )
+        searchfilter = self._search_filter(searchstring)
+        sort_ctrl = SSSRequestControl(True, ordering_rules=[sort])
+        # VLV offsets start at 1
+        vlv_ctrl = VLVRequestControl(
+            True,
+            before_count=0,
+            after_count=limit - 1,
+            offset=offset + 1,
+            content_count=0,
+            )
+        self._logger(
+            severity=logging.DEBUG,
+            msg="%(backend)s: executing sorted search "
+                "with filter '%(filter)s' (sort: '%(sort)s', "
+                "offset: %(offset)d, limit: %(limit)d)" % {
+                    'backend': self.backend_name,
+                    'filter': self._uni(searchfilter),
+                    'sort': sort,
+                    'offset': offset,
+                    'limit': limit,
+                }
+        )
+        try:
+            with self._operation() as ldap_client:
+                msgid = ldap_client.search_ext(
+                    self.userdn,
+                    ldap.SCOPE_SUBTREE,
+                    searchfilter,
+                    attrlist=self.displayed_attrlist,
+                    serverctrls=[sort_ctrl, vlv_ctrl]
+                    )
+                rtype, rdata, rmsgid, serverctrls = \
+                    ldap_client.result3(msgid)
+        except (ldap.UNAVAILABLE_CRITICAL_EXTENSION,
+                ldap.UNWILLING_TO_PERFORM,
+                ldap.VLV_ERROR) as e:
+            rdata = None
+            serverctrls = []
+        except Exception as e:
+            self._exception_handler(e)
+
+        total = None
+        for ctrl in serverctrls:
+            if ctrl.controlType == VLVResponseControl.controlType and \
+                    ctrl.result == 0:
+                total = ctrl.contentCount
+        if total is None:
+            self._logger(
+                severity=logging.INFO,
+                msg="%(backend)s: server side sorting or VLV "
+                    "not supported, sorting in ldapcherry" % {
+                        'backend': self.backend_name,
+                    }
+            )
+            return super(Backend, self).search_sorted(
+                searchstring, sort, offset, limit
+            )
+        entries = [
+            self._decode_entry(entry) for entry in rdata
+            # skip search references
+            if entry[0] is not None
+        ]
+        return (self._search_result(entries), total)
+
     def get_user(self, username):
         """Gest a specific user"""
         ret = {}
-        tmp = self._get_user(self._byte_p2(username), ALL_ATTRS)
+        tmp = self._get_user(self._byte_p2(username), LISTED_ATTRS)
         if tmp is None:
             raise UserDoesntExist(username, self.backend_name)
         attrs_tmp = tmp[1]
@@ -648,18 +1401,168 @@ class Backend(ldapcherry.backend.Backend):
                 ret[attr] = value_tmp
         return ret
 
+    def _get_attr(self, attrs, attr):
+        """Get the values of an attribute
+        (the server may not use the same case for the name)
+        """
+        for a in attrs:
+            if a.lower() == attr.lower():
+                return attrs[a]
+        return []
+
+    def _dn_in(self, dn, basedn):
+        """Check if a dn is under basedn (at any depth)"""
+        dn = ldap.dn.str2dn(self._byte_p2(dn.lower()))
+        basedn = ldap.dn.str2dn(self._byte_p2(basedn.lower()))
+        return len(dn) > len(basedn) and dn[-len(basedn):] == basedn
+
+    def _get_membership(self, username):
+        """Get the dn of all the groups of a user from
+        the membership attribute of his entry (one search)
+        """
+        tmp = self._get_user(
+            self._byte_p2(username),
+            self._projection([self.membership_attr])
+        )
+        if tmp is None:
+            return []
+        return self._get_attr(tmp[1], self.membership_attr)
+
+    def _group_bases(self):
+        """Base dns of the groups"""
+        return [self.groupdn]
+
+    def _group_name(self, dn):
+        """Name of a group from its dn (the dn itself)"""
+        return dn
+
+    def _membership_groups(self, dns):
+        """Keep the groups in the group bases from the values
+        of the membership attribute
+        """
+        ret = []
+        for dn in dns:
+            for groupdn in self._group_bases():
+                if self._dn_in(dn, groupdn):
+                    ret.append(self._group_name(dn))
+        return ret
+
     def get_groups(self, username):
         """Get all groups of a user"""
-        username = ldap.filter.escape_filter_chars(self._byte_p2(username))
-        userdn = self._get_user(username, NO_ATTR)
+        if self.membership_attr:
+            return self._membership_groups(self._get_membership(username))
 
-        searchfilter = self.group_filter_tmpl % {
-            'userdn': userdn,
-            'username': username
-        }
+        with self._operation():
+            userdn = self._get_user(self._byte_p2(username), NO_ATTR)
+            # the user is not in this backend
+            if userdn is None:
+                return []
 
-        groups = self._search(searchfilter, NO_ATTR, self.groupdn)
+            searchfilter = self.group_filter.build({
+                'userdn': userdn,
+                'username': username
+            })
+
+            groups = self._search(
+                self._byte_p2(searchfilter),
+                NO_ATTR,
+                self.groupdn
+            )
         ret = []
         for entry in groups:
             ret.append(self._uni(entry[0]))
         return ret
+
+    def _group_member(self):
+        """Attribute and value template of the groups members if
+        group_filter_tmpl is a single equality, ex:
+        (member=%(userdn)s) -> ('member', '', 'userdn', '')
+        (None if the group filter can't be inverted)
+        """
+        m = GROUP_MEMBER_FILTER_RE.match(self.group_filter_tmpl)
+        if m is None:
+            return None
+        return m.groups()
+
+    def _member_value(self, value):
+        """Normalized value of a group member (case insensitive,
+        dns are compared component by component)
+        """
+        value = value.lower()
+        try:
+            return ldap.dn.dn2str(ldap.dn.str2dn(self._byte_p2(value)))
+        except ldap.DECODING_ERROR:
+            return value
+
+    def get_groups_bulk(self, usernames):
+        """Get the groups of several users
+        (one search for the users and one for the groups, the members
+        of the groups are inverted instead of searching the groups
+        of each user)
+
+        The groups are inverted if group_filter_tmpl is a single
+        equality on the user dn or name, or read from membership_attr,
+        get_groups() is called for each user otherwise.
+        """
+        member = None
+        if not self.membership_attr:
+            member = self._group_member()
+            if member is None:
+                with self._operation():
+                    return super(Backend, self).get_groups_bulk(usernames)
+
+        ret = {}
+        wanted = {}
+        for username in usernames:
+            ret[username] = []
+            wanted[username.lower()] = username
+
+        attrs = [self.key]
+        if self.membership_attr:
+            attrs.append(self.membership_attr)
+        # the user filter with a wildcard matches all the users
+        user_filter = self.user_filter.tmpl % {'username': '*'}
+
+        with self._operation():
+            # expected value of the member attribute -> user
+            members = {}
+            for dn, user_attrs in self._iter_search(
+                    self._byte_p2(user_filter),
+                    self._projection(attrs),
+                    self.userdn):
+                for key in self._get_attr(user_attrs, self.key):
+                    if key.lower() in wanted:
+                        break
+                else:
+                    continue
+                username = wanted[key.lower()]
+                if self.membership_attr:
+                    ret[username] = self._membership_groups(
+                        self._get_attr(user_attrs, self.membership_attr)
+                    )
+                    continue
+                attr, prefix, value_key, suffix = member
+                if value_key == 'userdn':
+                    value = dn
+                else:
+                    value = username
+                members[self._member_value(prefix + value + suffix)] = \
+                    username
+
+            if self.membership_attr:
+                return ret
+
+            attr = member[0]
+            for groupdn in self._group_bases():
+                for dn, group_attrs in self._iter_search(
+                        self._byte_p2('(%s=*)' % attr),
+                        self._projection([attr]),
+                        groupdn):
+                    users = set([])
+                    for value in self._get_attr(group_attrs, attr):
+                        username = members.get(self._member_value(value))
+                        if username is not None:
+                            users.add(username)
+                    for username in users:
+                        ret[username].append(self._group_name(dn))
+        return ret
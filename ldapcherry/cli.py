@@ -8,21 +8,24 @@
 """The CherryPy daemon."""
 
 import sys
+import os
 import os.path
+import time
+import errno
+import json
+import signal
+import socket
+import logging
 
 import cherrypy
 from cherrypy.process import plugins, servers
 from cherrypy import Application
 from ldapcherry import LdapCherry
+from ldapcherry.roles import Roles
 
 
-def start(configfile=None, daemonize=False, environment=None,
-          fastcgi=False, scgi=False, pidfile=None,
-          cgi=False, debug=False):
-    """Subscribe all engine plugins and start the engine."""
-    sys.path = [''] + sys.path
-
-    # monkey patching cherrypy to disable config interpolation
+def _disable_interpolation():
+    """Monkey patch cherrypy to disable config interpolation"""
     def new_as_dict(self, raw=True, vars=None):
         """Convert an INI file to a dictionary"""
         # Load INI file into a dict
@@ -44,10 +47,229 @@ def start(configfile=None, daemonize=False, environment=None,
         return result
     cherrypy.lib.reprconf.Parser.as_dict = new_as_dict
 
+
+def compile_roles(configfile):
+    """Build the compiled roles file (roles.compiled_file)."""
+    _disable_interpolation()
+    config = cherrypy.lib.reprconf.Parser().dict_from_file(configfile)
+    roles_config = config.get('roles', {})
+    if not roles_config.get('roles.compiled_file'):
+        print('roles.compiled_file is not set in "' + configfile + '"')
+        exit(1)
+    try:
+        roles = Roles(roles_config['roles.file'])
+        roles.save_compiled(roles_config['roles.compiled_file'])
+    except Exception as e:
+        print(getattr(e, 'log', str(e)))
+        exit(1)
+    print('compiled roles file "' +
+          roles_config['roles.compiled_file'] + '" written')
+
+
+def audit_roles(configfile, debug=False):
+    """Print the roles of all the users (json)."""
+    _disable_interpolation()
     instance = LdapCherry()
     app = cherrypy.tree.mount(instance, '/', configfile)
     cherrypy.config.update(configfile)
     instance.reload(app.config, debug)
+    try:
+        roles = instance.audit_roles()
+    except Exception as e:
+        print(getattr(e, 'log', str(e)))
+        exit(1)
+    print(json.dumps(roles, indent=4, sort_keys=True))
+
+
+def _subscribe_handlers(engine, instance):
+    """Subscribe the reload of the roles and attributes files
+    and the signal handlers
+    """
+    # SIGHUP reloads the roles and attributes files
+    # instead of restarting the whole process
+    engine.subscribe('graceful', lambda: instance.reload_files(True))
+    if instance.files_reload_interval:
+        plugins.Monitor(
+            engine,
+            instance.reload_files,
+            instance.files_reload_interval,
+            name='ldapcherry files reload',
+        ).subscribe()
+
+    if hasattr(engine, "signal_handler"):
+        engine.signal_handler.handlers['SIGHUP'] = engine.graceful
+        engine.signal_handler.subscribe()
+    if hasattr(engine, "console_control_handler"):
+        engine.console_control_handler.subscribe()
+
+
+def _shared_sessions(app):
+    """Check if the sessions are stored outside of the process"""
+    config = dict(cherrypy.config)
+    config.update(app.config.get('/', {}))
+    if not config.get('tools.sessions.on', False):
+        return True
+    storage_class = config.get('tools.sessions.storage_class')
+    if storage_class is not None:
+        return storage_class is not cherrypy.lib.sessions.RamSession
+    return config.get('tools.sessions.storage_type', 'ram') != 'ram'
+
+
+def _check_workers(app, fastcgi=False, scgi=False, cgi=False):
+    """Check that the configuration allows several worker processes
+    (returns the error message, None if the configuration is valid)
+    """
+    if fastcgi or scgi or cgi:
+        return ("The workers option is only available with "
+                "the default HTTP server.")
+    if not _shared_sessions(app):
+        return ("The workers option requires a session "
+                "storage shared between processes "
+                "(tools.sessions.storage_class).")
+    return None
+
+
+def _disable_auth_cache(app):
+    """Disable the authentication cache (auth.cache_ttl): it is per
+    process, a password change in one worker wouldn't invalidate
+    the logins cached by the other workers
+    (returns True if the cache was enabled)
+    """
+    auth = app.config.get('auth', {})
+    if not int(auth.get('auth.cache_ttl', 0)):
+        return False
+    auth['auth.cache_ttl'] = 0
+    return True
+
+
+def _listen():
+    """Bind and listen on the address of the HTTP server
+    (the socket is shared by all the workers)
+    """
+    host = cherrypy.server.socket_host
+    port = cherrypy.server.socket_port
+    info = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                              socket.SOCK_STREAM, 0, socket.AI_PASSIVE)
+    af, socktype, proto, canonname, sa = info[0]
+    sock = socket.socket(af, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(sa)
+    sock.listen(cherrypy.server.socket_queue_size)
+    return sock
+
+
+def _worker(instance, app, sock, debug):
+    """Run a worker process on the shared socket"""
+    # connections pools and threads don't survive the fork,
+    # load everything again in the worker
+    instance.reload(app.config, debug)
+    engine = cherrypy.engine
+
+    # HTTP server using the shared socket instead of binding its own
+    cherrypy.server.unsubscribe()
+    httpserver, bind_addr = cherrypy.server.httpserver_from_self()
+
+    def bind(family, type, proto=0):
+        if httpserver.ssl_adapter is not None:
+            httpserver.socket = httpserver.ssl_adapter.bind(sock)
+        else:
+            httpserver.socket = sock
+        return httpserver.socket
+    httpserver.bind = bind
+    # no bind address, the port is already taken by the master
+    servers.ServerAdapter(engine, httpserver=httpserver).subscribe()
+
+    _subscribe_handlers(engine, instance)
+    try:
+        engine.start()
+    except Exception as e:
+        os._exit(1)
+    engine.block()
+    os._exit(0)
+
+
+def prefork(instance, app, workers, daemonize=False, pidfile=None,
+            debug=False):
+    """Run the workers processes and restart them if they die.
+
+    SIGHUP is forwarded to the workers (reload of the roles and
+    attributes files), SIGTERM and SIGINT stop them.
+    """
+    engine = cherrypy.engine
+    sock = _listen()
+
+    if daemonize:
+        cherrypy.config.update({'log.screen': False})
+        plugins.Daemonizer(engine).start()
+    if pidfile:
+        pidfile_plugin = plugins.PIDFile(engine, pidfile)
+        pidfile_plugin.start()
+
+    children = {}
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            _worker(instance, app, sock, debug)
+        children[pid] = time.time()
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    def reload(signum, frame):
+        for pid in children:
+            os.kill(pid, signal.SIGHUP)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+
+    for i in range(workers):
+        spawn()
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        cherrypy.log.error(
+            msg="worker %(pid)d exited (status %(status)d), restarting" % {
+                'pid': pid,
+                'status': status,
+            },
+            severity=logging.WARNING
+        )
+        # avoid a fork loop if the workers can't start
+        if time.time() - started < 1:
+            time.sleep(1)
+        spawn()
+
+    if pidfile:
+        pidfile_plugin.exit()
+
+
+def start(configfile=None, daemonize=False, environment=None,
+          fastcgi=False, scgi=False, pidfile=None,
+          cgi=False, debug=False, workers=1):
+    """Subscribe all engine plugins and start the engine."""
+    sys.path = [''] + sys.path
+
+    _disable_interpolation()
+
+    instance = LdapCherry()
+    app = cherrypy.tree.mount(instance, '/', configfile)
+    cherrypy.config.update(configfile)
+    # with workers, the master process only checks the configuration
+    instance.reload(app.config, debug, check_only=workers > 1)
 
     engine = cherrypy.engine
 
@@ -57,6 +279,20 @@ def start(configfile=None, daemonize=False, environment=None,
     if environment is not None:
         cherrypy.config.update({'environment': environment})
 
+    if workers > 1:
+        error = _check_workers(app, fastcgi, scgi, cgi)
+        if error is not None:
+            cherrypy.log.error(error, 'ENGINE')
+            sys.exit(1)
+        if _disable_auth_cache(app):
+            cherrypy.log.error(
+                msg="auth.cache_ttl is ignored with the workers option "
+                    "(the cache can't be invalidated in all the workers)",
+                severity=logging.WARNING
+            )
+        prefork(instance, app, workers, daemonize, pidfile, debug)
+        return
+
     # Only daemonize if asked to.
     if daemonize:
         # Don't print anything to stdout/sterr.
@@ -66,10 +302,7 @@ def start(configfile=None, daemonize=False, environment=None,
     if pidfile:
         plugins.PIDFile(engine, pidfile).subscribe()
 
-    if hasattr(engine, "signal_handler"):
-        engine.signal_handler.subscribe()
-    if hasattr(engine, "console_control_handler"):
-        engine.console_control_handler.subscribe()
+    _subscribe_handlers(engine, instance)
 
     if (fastcgi and (scgi or cgi)) or (scgi and cgi):
         cherrypy.log.error("You may only specify one of the cgi, fastcgi, and "
@@ -125,6 +358,14 @@ def main():
                  help="add the given paths to sys.path")
     p.add_option('-D', '--debug', action="store_true", dest='debug',
                  help="debug to stderr in foreground")
+    p.add_option('-w', '--workers', type='int', dest='workers', default=1,
+                 help="number of worker processes (default: 1)")
+    p.add_option('-r', '--compile-roles', action="store_true",
+                 dest='compile_roles',
+                 help="build the compiled roles file and exit")
+    p.add_option('-a', '--audit-roles', action="store_true",
+                 dest='audit_roles',
+                 help="print the roles of all the users (json) and exit")
     options, args = p.parse_args()
 
     if options.Path:
@@ -139,9 +380,18 @@ def main():
         print('configuration file "' + options.config + '" doesn\'t exist')
         exit(1)
 
+    if options.compile_roles:
+        compile_roles(options.config)
+        exit(0)
+
+    if options.audit_roles:
+        audit_roles(options.config, options.debug)
+        exit(0)
+
     start(options.config, options.daemonize,
           options.environment, options.fastcgi, options.scgi,
-          options.pidfile, options.cgi, options.debug)
+          options.pidfile, options.cgi, options.debug,
+          options.workers)
 
 
 if __name__ == '__main__':
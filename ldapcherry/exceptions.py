@@ -218,6 +218,16 @@ class GroupDoesntExist(Exception):
             " in backend '" + backend + "'"
 
 
+class BackendTimeout(Exception):
+    def __init__(self, backend, timeout):
+        self.backend = backend
+        self.timeout = timeout
+        self.log = \
+            "backend '%(backend)s' did not answer" \
+            " within %(timeout)s seconds" % \
+            {'backend': backend, 'timeout': timeout}
+
+
 class TemplateRenderError(Exception):
     def __init__(self, error):
         self.log = "Template Render Error: " + error
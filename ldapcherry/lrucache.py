@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# vim:set expandtab tabstop=4 shiftwidth=4:
+#
+# The MIT License (MIT)
+# LdapCherry
+# Copyright (c) 2014 Carpentier Pierre-Francois
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread safe cache keeping at most 'maxsize' entries
+
+    When full, the least recently used entry is evicted.
+    If 'ttl' is set, entries older than 'ttl' seconds are expired.
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+    def get(self, key, default=None):
+        """get the value of key (default if absent or expired)"""
+        with self._lock:
+            try:
+                value, expire = self._entries.pop(key)
+            except KeyError:
+                self._stats['misses'] += 1
+                return default
+            if expire is not None and expire <= time.time():
+                self._stats['misses'] += 1
+                return default
+            # most recently used entries are at the end
+            self._entries[key] = (value, expire)
+            self._stats['hits'] += 1
+            return value
+
+    def set(self, key, value):
+        """set the value of key"""
+        if self.ttl:
+            expire = time.time() + self.ttl
+        else:
+            expire = None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expire)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, key):
+        """remove key from the cache"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """remove all the entries"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """return the statistics of the cache"""
+        with self._lock:
+            ret = dict(self._stats)
+            ret['size'] = len(self._entries)
+            ret['maxsize'] = self.maxsize
+        return ret
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
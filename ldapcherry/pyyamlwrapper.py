@@ -30,6 +30,14 @@ try:
 except ImportError:
     from yaml import Loader, Dumper
 
+# LibYAML (C) based safe loader if available
+try:
+    from yaml import CSafeLoader as SafeLoader
+    LIBYAML = True
+except ImportError:
+    from yaml import SafeLoader
+    LIBYAML = False
+
 
 # PyYaml wrapper that loads yaml files throwing an exception
 # if a key is dumplicated
@@ -70,8 +78,31 @@ class MyLoader(Reader, Scanner, Parser, Composer, Constructor, Resolver):
         return mapping
 
 
-def loadNoDump(stream):
-    loader = MyLoader(stream)
+# Safe yaml loader (LibYAML based if available) throwing an exception
+# if a key is dumplicated, much faster than MyLoader
+class NoDumpLoader(SafeLoader):
+
+    def construct_mapping(self, node, deep=False):
+        if isinstance(node, MappingNode):
+            keys = {}
+            for key_node, value_node in node.value:
+                # merged keys ('<<') can be overridden
+                if key_node.tag == 'tag:yaml.org,2002:merge':
+                    continue
+                key = self.construct_object(key_node, deep=deep)
+                try:
+                    dumplicated = key in keys
+                except TypeError:
+                    # unhashable key, refused below
+                    continue
+                if dumplicated:
+                    raise DumplicatedKey(key, '')
+                keys[key] = True
+        return SafeLoader.construct_mapping(self, node, deep=deep)
+
+
+def loadNoDump(stream, loader_class=NoDumpLoader):
+    loader = loader_class(stream)
     try:
         return loader.get_single_data()
     finally:
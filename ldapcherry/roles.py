@@ -8,15 +8,29 @@
 import os
 import sys
 import copy
+import json
+import hashlib
+import pickle
 
 from ldapcherry.pyyamlwrapper import loadNoDump
 from ldapcherry.pyyamlwrapper import DumplicatedKey
 from ldapcherry.exceptions import *
+from ldapcherry.lrucache import LRUCache
 import yaml
 
 if sys.version < '3':
     from sets import Set as set
 
+# version of the compiled roles format
+# (python 2 and 3 pickles differ)
+COMPILED_VERSION = (1, sys.version_info[0])
+# attributes of Roles saved in the compiled roles
+COMPILED_ATTRS = (
+    'backends', 'roles_raw', 'graph', 'roles', 'flatten', 'group2roles',
+    'admin_roles', 'graph_js', 'roles_js', 'display_names',
+    'role_groups', 'subroles_closure', 'matcher',
+)
+
 
 class CustomDumper(yaml.SafeDumper):
     "A custom YAML dumper that never emits aliases"
@@ -25,27 +39,134 @@ class CustomDumper(yaml.SafeDumper):
         return True
 
 
+class RoleMatcher(object):
+    """Compiled role membership engine
+
+    Each (backend, group) of the roles is interned to a bit,
+    each role becomes the mask of its groups, and the groups of a user
+    are turned into a mask too: the user is member of a role if his
+    mask contains the mask of the role.
+    """
+
+    def __init__(self, flatten):
+        self.bits = {}
+        self.masks = []
+        for roleid in flatten:
+            mask = 0
+            backends_groups = flatten[roleid]['backends_groups']
+            for b in backends_groups:
+                for g in backends_groups[b]:
+                    if (b, g) not in self.bits:
+                        self.bits[(b, g)] = 1 << len(self.bits)
+                    mask |= self.bits[(b, g)]
+            self.masks.append((roleid, mask))
+
+    def mask(self, groups):
+        """mask of groups ({<backend>: [<groups>]}),
+        groups not used by any role are ignored
+        """
+        mask = 0
+        for b in groups:
+            for g in groups[b]:
+                mask |= self.bits.get((b, g), 0)
+        return mask
+
+    def match(self, groups):
+        """get the roles of a user from his groups
+        ({<backend>: [<groups>]}) and the groups not matching
+        any of these roles
+        """
+        user_mask = self.mask(groups)
+        roles = set([])
+        used = 0
+        for roleid, mask in self.masks:
+            if mask & user_mask == mask:
+                roles.add(roleid)
+                used |= mask
+        unusedgroups = {}
+        for b in groups:
+            for g in groups[b]:
+                if not self.bits.get((b, g), 0) & used:
+                    if b not in unusedgroups:
+                        unusedgroups[b] = set([])
+                    unusedgroups[b].add(g)
+        return {'roles': roles, 'unusedgroups': unusedgroups}
+
+
 class Roles:
 
-    def __init__(self, role_file):
+    def __init__(self, role_file, cache_size=1000, compiled_file=None):
         self.role_file = role_file
-        self.backends = set([])
         try:
             stream = open(role_file, 'r')
         except Exception as e:
             raise MissingRolesFile(role_file)
+        with open(role_file, 'rb') as f:
+            self.digest = hashlib.sha256(f.read()).hexdigest()
+
+        # the computed roles are loaded from the compiled file
+        # if it was built from the same roles file
+        self.compiled = compiled_file is not None and \
+            self._load_compiled(compiled_file)
+        if self.compiled:
+            stream.close()
+        else:
+            self.backends = set([])
+            try:
+                self.roles_raw = loadNoDump(stream)
+            except DumplicatedKey as e:
+                raise DumplicateRoleKey(e.key)
+            stream.close()
+
+            self.graph = {}
+            self.roles = {}
+            self.flatten = {}
+            self.group2roles = {}
+            self.admin_roles = []
+            self._nest()
+            self._serialize()
+            self._precompute()
+            self.matcher = RoleMatcher(self.flatten)
+
+        # results of get_roles by set of groups
+        # (many users share the same groups)
+        if cache_size:
+            self.roles_cache = LRUCache(cache_size)
+        else:
+            self.roles_cache = None
+
+    def _load_compiled(self, compiled_file):
+        """load the computed roles from a compiled file
+        returns False if the file is missing, unreadable or outdated
+        """
         try:
-            self.roles_raw = loadNoDump(stream)
-        except DumplicatedKey as e:
-            raise DumplicateRoleKey(e.key)
-        stream.close()
-
-        self.graph = {}
-        self.roles = {}
-        self.flatten = {}
-        self.group2roles = {}
-        self.admin_roles = []
-        self._nest()
+            with open(compiled_file, 'rb') as f:
+                version, digest, state = pickle.load(f)
+        except Exception as e:
+            return False
+        if version != COMPILED_VERSION or digest != self.digest:
+            return False
+        for attr in COMPILED_ATTRS:
+            setattr(self, attr, state[attr])
+        return True
+
+    def save_compiled(self, compiled_file):
+        """save the computed roles in a compiled file
+        (loaded instead of parsing the roles file as long
+        as it doesn't change)
+        """
+        state = {}
+        for attr in COMPILED_ATTRS:
+            state[attr] = getattr(self, attr)
+        # write and rename, a worker must not read a partial file
+        tmp = '%s.%d.tmp' % (compiled_file, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(
+                (COMPILED_VERSION, self.digest, state),
+                f,
+                pickle.HIGHEST_PROTOCOL,
+            )
+        os.rename(tmp, compiled_file)
 
     def _merge_groups(self, backends_list):
         """ merge a list backends_groups"""
@@ -87,38 +208,26 @@ class Roles:
             self.admin_roles.append(r)
             self._set_admin(role['subroles'][r])
 
-    def _is_parent(self, roleid1, roleid2):
-        """Test if roleid1 is contained inside roleid2"""
-
-        role2 = copy.deepcopy(self.flatten[roleid2])
-        role1 = copy.deepcopy(self.flatten[roleid1])
-
-        if role1 == role2:
-            return False
-
-        # Check if role1 is contained by role2
-        for b1 in role1['backends_groups']:
-            if b1 not in role2['backends_groups']:
-                return False
-            for group in role1['backends_groups'][b1]:
-                if group not in role2['backends_groups'][b1]:
-                    return False
-
-        # If role2 is inside role1, roles are equal, throw exception
-        for b2 in role2['backends_groups']:
-            if b2 not in role1['backends_groups']:
-                return True
-            for group in role2['backends_groups'][b2]:
-                if group not in role1['backends_groups'][b2]:
-                    return True
-        raise DumplicateRoleContent(roleid1, roleid2)
+    def _groups_key(self, role):
+        """frozenset of the (backend, group) of a role
+        ((backend, None) marks each backend, even without groups)
+        """
+        key = set([])
+        for b in role['backends_groups']:
+            key.add((b, None))
+            for g in role['backends_groups'][b]:
+                key.add((b, g))
+        return frozenset(key)
 
     def _nest(self):
-        """nests the roles (creates roles hierarchy)"""
+        """nests the roles (creates roles hierarchy)
+
+        role1 is a parent of role2 if the groups of role1
+        are strictly included in the groups of role2.
+        """
         self._flatten()
-        parent_roles = {}
         for roleid in self.flatten:
-            role = copy.deepcopy(self.flatten[roleid])
+            role = self.flatten[roleid]
 
             # Display name is mandatory
             if 'display_name' not in role:
@@ -141,9 +250,21 @@ class Roles:
                     'sub_roles': set([])
                     }
 
-        # Create the nested groups
+        # index the roles by group (and by set of groups)
+        keys = {}
+        key2role = {}
+        roles_by_group = {}
+        order = {}
         for roleid in self.flatten:
-            role = copy.deepcopy(self.flatten[roleid])
+            order[roleid] = len(order)
+            role = self.flatten[roleid]
+            key = self._groups_key(role)
+            # two roles with the same groups are the same role
+            if key in key2role and \
+                    self.flatten[key2role[key]] != role:
+                raise DumplicateRoleContent(key2role[key], roleid)
+            key2role[key] = roleid
+            keys[roleid] = key
             # create reverse groups 2 roles
             for b in role['backends_groups']:
                 for g in role['backends_groups'][b]:
@@ -152,35 +273,54 @@ class Roles:
                     if g not in self.group2roles[b]:
                         self.group2roles[b][g] = set([])
                     self.group2roles[b][g].add(roleid)
-
-            parent_roles[roleid] = []
-            for roleid2 in self.flatten:
-                role2 = copy.deepcopy(self.flatten[roleid2])
-                if self._is_parent(roleid, roleid2):
-                    parent_roles[roleid].append(roleid2)
-                    self.graph[roleid2]['parent_roles'].add(roleid)
-                    self.graph[roleid]['sub_roles'].add(roleid2)
-
-        for r in parent_roles:
-            for p in parent_roles[r]:
-                for p2 in parent_roles[r]:
-                    if p != p2 and p in parent_roles[p2]:
-                        parent_roles[r].remove(p)
+            for item in key:
+                if item not in roles_by_group:
+                    roles_by_group[item] = set([])
+                roles_by_group[item].add(roleid)
+
+        # the sub roles of a role are the other roles having
+        # all its groups (intersection of the roles of each group)
+        sub_roles = {}
+        all_roles = frozenset(self.flatten)
+        for roleid in self.flatten:
+            containers = all_roles
+            for item in sorted(keys[roleid],
+                               key=lambda i: len(roles_by_group[i])):
+                containers = containers.intersection(roles_by_group[item])
+            sub_roles[roleid] = frozenset(
+                [r for r in containers if keys[r] != keys[roleid]]
+            )
+            for roleid2 in sub_roles[roleid]:
+                self.graph[roleid2]['parent_roles'].add(roleid)
+                self.graph[roleid]['sub_roles'].add(roleid2)
+
+        # only keep the direct sub roles (transitive reduction):
+        # a sub role of another sub role is not direct
+        direct_sub_roles = {}
+        for roleid in self.flatten:
+            indirect = set([])
+            for roleid2 in sub_roles[roleid]:
+                indirect.update(sub_roles[roleid2])
+            direct_sub_roles[roleid] = sorted(
+                sub_roles[roleid].difference(indirect),
+                key=lambda r: order[r]
+            )
+
+        # build each node of the hierarchy once
+        # (sub trees are shared between their parents)
+        nodes = {}
 
         def nest(p):
-            ret = copy.deepcopy(self.flatten[p])
-            ret['subroles'] = {}
-            if len(parent_roles[p]) == 0:
-                return ret
-            else:
-                for i in parent_roles[p]:
-                    sub = nest(i)
-                    ret['subroles'][i] = sub
-                return ret
-
-        for p in parent_roles.keys():
-            if p in parent_roles:
-                self.roles[p] = nest(p)
+            if p not in nodes:
+                ret = copy.deepcopy(self.flatten[p])
+                ret['subroles'] = {}
+                for i in direct_sub_roles[p]:
+                    ret['subroles'][i] = nest(i)
+                nodes[p] = ret
+            return nodes[p]
+
+        for p in self.flatten:
+            self.roles[p] = nest(p)
 
         for roleid in self.roles:
             role = self.roles[roleid]
@@ -189,6 +329,37 @@ class Roles:
                 self.admin_roles.append(roleid)
                 self._set_admin(role)
 
+    def _serialize(self):
+        """precompute the display names and the json versions of
+        the roles graph and display names (used by the role forms)
+        """
+        graph = {}
+        for r in self.graph:
+            s = list(self.graph[r]['sub_roles'])
+            p = list(self.graph[r]['parent_roles'])
+            graph[r] = {'sub_roles': s, 'parent_roles': p}
+        self.graph_js = json.dumps(graph, separators=(',', ':'))
+        self.display_names = {}
+        for r in self.flatten:
+            self.display_names[r] = self.flatten[r]['display_name']
+        self.roles_js = json.dumps(self.display_names, separators=(',', ':'))
+
+    def _precompute(self):
+        """precompute the (frozen) group sets and sub roles closure
+        of each role, used to compute the group modifications
+        """
+        self.role_groups = {}
+        self.subroles_closure = {}
+        for roleid in self.flatten:
+            backends_groups = self.flatten[roleid]['backends_groups']
+            self.role_groups[roleid] = dict(
+                (b, frozenset(backends_groups[b])) for b in backends_groups
+            )
+            # the sub roles in the graph are all the (direct or not)
+            # sub roles
+            self.subroles_closure[roleid] = \
+                frozenset(self.graph[roleid]['sub_roles'])
+
     def get_admin_roles(self):
         return self.admin_roles
 
@@ -200,132 +371,90 @@ class Roles:
         """dump the nested role hierarchy"""
         return yaml.dump(self.flatten, Dumper=CustomDumper)
 
-    def _check_member(
-            self, role, groups, notroles,
-            roles, parentroles, usedgroups):
-
-        # if we have already calculate user is not member of role
-        # return False
-        if role in notroles:
-            return False
-
-        # if we have already calculate that user is already member, skip
-        # role membership calculation
-        # (parentroles is a list of roles that the user is member of by
-        # being member of one of their subroles)
-        if not (role in parentroles or role in roles):
-            for b in self.roles[role]['backends_groups']:
-                for g in self.roles[role]['backends_groups'][b]:
-                    if b not in groups:
-                        notroles.add(role)
-                        return False
-                    if g not in groups[b]:
-                        notroles.add(role)
-                        return False
-
-        # add groups of the role to usedgroups
-        for b in self.roles[role]['backends_groups']:
-            if b not in usedgroups:
-                usedgroups[b] = set([])
-            for g in self.roles[role]['backends_groups'][b]:
-                usedgroups[b].add(g)
-
-        flag = True
-        # recursively determine if user is member of any subrole
-        for subrole in self.roles[role]['subroles']:
-            flag = flag and not \
-                self._check_member(
-                    subrole,
-                    groups,
-                    notroles,
-                    roles,
-                    parentroles,
-                    usedgroups,
-                    )
-        # if not, add role to the list of roles
-        if flag:
-            roles.add(role)
-        # else remove it from the list of roles and add
-        # it to the list of parentroles
-        else:
-            if role in roles:
-                roles.remove(role)
-            parentroles.add(role)
-        return True
-
     def get_groups_to_remove(self, current_roles, roles_to_remove):
         """get groups to remove from list of
         roles to remove and current roles
         """
         current_roles = set(current_roles)
-
-        ret = {}
         roles_to_remove = set(roles_to_remove)
-        tmp = set([])
         # get sub roles of the role to remove that the user belongs to
         # if we remove a role, there is no reason to keep the sub roles
-        for r in roles_to_remove:
-            for sr in self._get_subroles(r):
-                if sr not in roles_to_remove and sr in current_roles:
-                    tmp.add(sr)
+        for r in list(roles_to_remove):
+            roles_to_remove.update(
+                current_roles.intersection(self.subroles_closure[r])
+            )
 
-        roles_to_remove = roles_to_remove.union(tmp)
-        roles = current_roles.difference(set(roles_to_remove))
+        roles = current_roles.difference(roles_to_remove)
         groups_roles = self._get_groups(roles)
         groups_roles_to_remove = self._get_groups(roles_to_remove)
 
         # if groups belongs to roles the user keeps, don't remove it
         for b in groups_roles_to_remove:
             if b in groups_roles:
-                groups_roles_to_remove[b] = \
-                    groups_roles_to_remove[b].difference(groups_roles[b])
+                groups_roles_to_remove[b].difference_update(groups_roles[b])
         return groups_roles_to_remove
 
     def _get_groups(self, roles):
         ret = {}
         for r in roles:
-            for b in self.flatten[r]['backends_groups']:
-                groups = self.flatten[r]['backends_groups'][b]
+            role_groups = self.role_groups[r]
+            for b in role_groups:
                 if b not in ret:
-                    ret[b] = set(groups)
-                ret[b] = ret[b].union(set(groups))
+                    ret[b] = set(role_groups[b])
+                else:
+                    ret[b].update(role_groups[b])
         return ret
 
-    def _get_subroles(self, role):
-        ret = set([])
-        for sr in self.graph[role]['sub_roles']:
-            tmp = self._get_subroles(sr)
-            tmp.add(sr)
-            ret = ret.union(tmp)
-        return ret
+    @staticmethod
+    def _roles_key(groups):
+        """key of a group mapping in the roles cache"""
+        return frozenset(
+            (b, frozenset(groups[b])) for b in groups
+        )
+
+    @staticmethod
+    def _copy_roles(roles):
+        """copy of a get_roles result"""
+        unusedgroups = {}
+        for b in roles['unusedgroups']:
+            unusedgroups[b] = set(roles['unusedgroups'][b])
+        return {
+            'roles': set(roles['roles']),
+            'unusedgroups': unusedgroups,
+        }
 
     def get_roles(self, groups):
         """get list of roles and list of standalone groups"""
-        roles = set([])
-        parentroles = set([])
-        notroles = set([])
-        tmp = set([])
-        usedgroups = {}
-        unusedgroups = {}
+        if self.roles_cache is None:
+            return self._get_roles(groups)
+        key = self._roles_key(groups)
+        ret = self.roles_cache.get(key)
+        if ret is None:
+            ret = self._get_roles(groups)
+            self.roles_cache.set(key, ret)
+        # return a copy, the cached result must not be modified
+        return self._copy_roles(ret)
+
+    def get_roles_bulk(self, users_groups):
+        """get the roles of several users at once
+        ({<user>: {<backend>: [<groups>]}}), users with the same
+        groups are resolved only once
+        returns {<user>: <get_roles() result>}
+        """
+        resolved = {}
         ret = {}
-        # determine roles membership
-        for role in self.roles:
-            if self._check_member(
-                    role, groups, notroles,
-                    tmp, parentroles, usedgroups):
-                roles.add(role)
-        # determine standalone groups not matching any roles
-        for b in groups:
-            for g in groups[b]:
-                if b not in usedgroups or g not in usedgroups[b]:
-                    if b not in unusedgroups:
-                        unusedgroups[b] = set([])
-                    unusedgroups[b].add(g)
-
-        ret['roles'] = roles
-        ret['unusedgroups'] = unusedgroups
+        for user in users_groups:
+            groups = users_groups[user]
+            key = self._roles_key(groups)
+            if key not in resolved:
+                resolved[key] = self._get_roles(groups)
+            ret[user] = self._copy_roles(resolved[key])
         return ret
 
+    def _get_roles(self, groups):
+        """compute the list of roles and list of standalone groups"""
+        return self.matcher.match(groups)
+
     def get_allroles(self):
         """get the list of roles"""
         return self.flatten.keys()
@@ -338,14 +467,12 @@ class Roles:
 
     def get_groups(self, roles):
         """get the list of groups from role"""
-        ret = {}
         for role in roles:
             if role not in self.flatten:
                 raise MissingRole(role)
-            for b in self.flatten[role]['backends_groups']:
-                if b not in ret:
-                    ret[b] = []
-                ret[b] = ret[b] + self.flatten[role]['backends_groups'][b]
+        ret = self._get_groups(roles)
+        for b in ret:
+            ret[b] = sorted(ret[b])
         return ret
 
     def is_admin(self, roles):
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# vim:set expandtab tabstop=4 shiftwidth=4:
+#
+# The MIT License (MIT)
+# LdapCherry
+# Copyright (c) 2014 Carpentier Pierre-Francois
+
+import os
+import time
+import datetime
+import sqlite3
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from cherrypy.lib import sessions
+
+
+class SQLiteSession(sessions.Session):
+    """Session storage in a SQLite database (WAL journal)
+
+    The database file (storage_path) can be shared by several processes
+    on the same host (ldapcherryd --workers).
+
+    The session data is only written back if it was modified during
+    the request, or if less than half of the timeout is left before
+    its expiration (the expiration is not refreshed at each request).
+
+    Sessions are locked per process: between processes, the last
+    request to modify a session wins.
+    """
+
+    # Class-level objects. Don't rebind these!
+    locks = {}
+    connections = threading.local()
+
+    storage_path = None
+    # seconds to wait for the database if another process is writing
+    db_timeout = 10
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    @classmethod
+    def setup(cls, **kwargs):
+        """Set up the database (called once per process by the session
+        tool, with the tools.sessions.* parameters)
+        """
+        kwargs['storage_path'] = os.path.abspath(kwargs['storage_path'])
+        for k, v in kwargs.items():
+            setattr(cls, k, v)
+        conn = cls._connect()
+        # WAL is persistent, readers don't block the writer
+        # (and the other way around)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS session '
+            '(id TEXT PRIMARY KEY, data BLOB, expiration REAL)'
+        )
+
+    @classmethod
+    def _connect(cls):
+        """get the connection of the current thread (sqlite connections
+        can't be shared by threads or survive a fork)
+        """
+        key = (os.getpid(), cls.storage_path)
+        conn = getattr(cls.connections, 'conn', None)
+        if conn is None or cls.connections.key != key:
+            conn = sqlite3.connect(
+                cls.storage_path,
+                timeout=cls.db_timeout,
+                isolation_level=None,
+                )
+            # durable enough with WAL, a crash only loses
+            # the last sessions writes
+            conn.execute('PRAGMA synchronous=NORMAL')
+            cls.connections.conn = conn
+            cls.connections.key = key
+        return conn
+
+    @staticmethod
+    def _timestamp(date):
+        return time.mktime(date.timetuple()) + date.microsecond / 1e6
+
+    def _exists(self):
+        cur = self._connect().execute(
+            'SELECT 1 FROM session WHERE id = ?',
+            (self.id,),
+            )
+        return cur.fetchone() is not None
+
+    def _load(self):
+        self._stored = None
+        cur = self._connect().execute(
+            'SELECT data, expiration FROM session WHERE id = ?',
+            (self.id,),
+            )
+        row = cur.fetchone()
+        if row is None:
+            return None
+        blob = bytes(row[0])
+        try:
+            data = pickle.loads(blob)
+        except Exception:
+            return None
+        # remember what is stored to only write back modifications
+        self._stored = (self.id, blob, row[1])
+        return (data, datetime.datetime.fromtimestamp(row[1]))
+
+    def _save(self, expiration_time):
+        blob = pickle.dumps(self._data, self.pickle_protocol)
+        stored = getattr(self, '_stored', None)
+        if stored is not None and stored[:2] == (self.id, blob):
+            remaining = stored[2] - self._timestamp(self.now())
+            if remaining > self.timeout * 60 / 2:
+                return
+        expiration = self._timestamp(expiration_time)
+        self._connect().execute(
+            'INSERT OR REPLACE INTO session (id, data, expiration) '
+            'VALUES (?, ?, ?)',
+            (self.id, sqlite3.Binary(blob), expiration),
+            )
+        self._stored = (self.id, blob, expiration)
+
+    def _delete(self):
+        self._connect().execute(
+            'DELETE FROM session WHERE id = ?',
+            (self.id,),
+            )
+        self._stored = None
+
+    def acquire_lock(self):
+        """Acquire an exclusive lock on the currently-loaded session data."""
+        self.locked = True
+        self.locks.setdefault(self.id, threading.RLock()).acquire()
+
+    def release_lock(self):
+        """Release the lock on the currently-loaded session data."""
+        self.locks[self.id].release()
+        self.locked = False
+
+    def clean_up(self):
+        """Clean up expired sessions."""
+        self._connect().execute(
+            'DELETE FROM session WHERE expiration <= ?',
+            (self._timestamp(self.now()),),
+            )
+        # remove the locks of the sessions not in use
+        for _id in list(self.locks):
+            if self.locks[_id].acquire(False):
+                lock = self.locks.pop(_id)
+                lock.release()
+
+    def __len__(self):
+        """Return the number of active sessions."""
+        cur = self._connect().execute(
+            'SELECT COUNT(*) FROM session WHERE expiration > ?',
+            (self._timestamp(self.now()),),
+            )
+        return cur.fetchone()[0]
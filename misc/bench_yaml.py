@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Compare the yaml loaders of ldapcherry on large generated roles files
+#
+# usage: python misc/bench_yaml.py [<number of roles> ...]
+
+from __future__ import print_function
+
+import sys
+import time
+
+from ldapcherry.pyyamlwrapper import loadNoDump, MyLoader, NoDumpLoader
+from ldapcherry.pyyamlwrapper import LIBYAML
+
+
+def gen_roles(count):
+    """generate a roles file with 'count' roles (3 groups each)"""
+    lines = []
+    for i in range(count):
+        lines.append('role%d:' % i)
+        lines.append('    display_name: "Role %d"' % i)
+        lines.append('    description: "generated role %d"' % i)
+        lines.append('    backends_groups:')
+        lines.append('        ldap:')
+        for j in range(3):
+            lines.append(
+                '            - cn=group%d-%d,ou=group,dc=example,dc=com'
+                % (i, j)
+            )
+        lines.append('        ad:')
+        lines.append('            - Group %d' % i)
+    return '\n'.join(lines) + '\n'
+
+
+def bench(loader_class, content, runs=3):
+    """best time of 'runs' loads of content"""
+    best = None
+    for run in range(runs):
+        start = time.time()
+        data = loadNoDump(content, loader_class)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best, data
+
+
+if __name__ == '__main__':
+    counts = [int(c) for c in sys.argv[1:]] or [100, 1000, 5000]
+    print('LibYAML available: %s' % LIBYAML)
+    for count in counts:
+        content = gen_roles(count)
+        t_py, d_py = bench(MyLoader, content)
+        t_c, d_c = bench(NoDumpLoader, content)
+        assert d_py == d_c
+        print(
+            '%6d roles (%5d KiB): MyLoader %.3fs, NoDumpLoader %.3fs'
+            ' (x%.1f)' % (count, len(content) / 1024, t_py, t_c, t_py / t_c)
+        )
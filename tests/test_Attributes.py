@@ -45,6 +45,12 @@ class TestError(object):
         expected.sort()
         assert ret == expected
 
+    def testGetBackendSearchAttributes(self):
+        inv = Attributes('./tests/cfg/attributes.yml')
+        ret = inv.get_backend_search_attributes('ad')
+        expected = ['UID', 'cn', 'givenName', 'sn']
+        assert ret == expected
+
     def testGetKey(self):
         inv = Attributes('./tests/cfg/attributes.yml')
         ret = inv.get_key()
@@ -7,6 +7,7 @@ from __future__ import unicode_literals
 import pytest
 import sys
 from ldapcherry.backend.backendAD import Backend
+from ldapcherry.backend.backendLdap import ConnectionPool
 from ldapcherry.exceptions import *
 from disable import travis_disabled
 import cherrypy
@@ -116,6 +117,50 @@ class TestError(object):
         inv.del_user(u'☭default_user')
         assert ret == expected
 
+    def testSearchNoServer(self):
+        class FakeClient(object):
+            def search_s(self, basedn, scope, searchfilter, attrlist=None):
+                if searchfilter.startswith('(member='):
+                    # groups are searched in CN=Users and CN=Builtin
+                    group = basedn.split(',')[0][3:]
+                    return [('CN=' + group + ',' + basedn, {
+                        'cn': [group.encode('utf-8')],
+                        })]
+                return [('CN=John Smith,CN=Users,DC=DC,DC=LDAPCHERRY,DC=ORG', {
+                    'sAMAccountName': [b'jsmith'],
+                    'cn': [b'John Smith'],
+                    })]
+            def unbind_s(self):
+                pass
+        inv = Backend(cfg, cherrypy.log, u'test☭', attr, 'sAMAccountName')
+        client = FakeClient()
+        inv.servers[0].pool = ConnectionPool(lambda: client, 1, 30)
+        assert inv.page_size == 0
+        assert list(inv.search(u'smith').keys()) == [u'jsmith']
+        assert inv.get_groups(u'jsmith') == [u'Users', u'Builtin']
+        assert inv.get_pool_stats()['in_use'] == 0
+
+    @travis_disabled
+    def testGetGroupsUserDontExists(self):
+        inv = Backend(cfg, cherrypy.log, u'test☭', attr, 'sAMAccountName')
+        ret = inv.get_groups(u'notauser')
+        assert ret == []
+
+    @travis_disabled
+    def testGetGroupsMemberOf(self):
+        cfg2 = cfg.copy()
+        cfg2['membership_attr'] = 'memberOf'
+        inv = Backend(cfg2, cherrypy.log, u'test☭', attr, 'sAMAccountName')
+        try:
+            inv.add_user(default_user.copy())
+            inv.add_to_groups(u'☭default_user', default_groups)
+        except:
+            pass
+        ret = inv.get_groups(u'☭default_user')
+        expected = ['Domain Admins', 'Backup Operators']
+        inv.del_user(u'☭default_user')
+        assert set(ret) == set(expected)
+
     @travis_disabled
     def testSearchUser(self):
         inv = Backend(cfg, cherrypy.log, u'test☭', attr, 'sAMAccountName')
@@ -87,6 +87,15 @@ class TestError(object):
         expected = set(default_groups)
         assert ret == expected
 
+    def testGetGroupsBulk(self):
+        inv = Backend(cfg, cherrypy.log, 'test', attr, 'uid')
+        inv.add_user(default_user)
+        inv.add_to_groups('default_user', default_groups)
+        ret = inv.get_groups_bulk(['default_user', 'admin', 'notauser'])
+        assert ret['default_user'] == set(default_groups)
+        assert ret['admin'] == set(['grp1', 'grp2'])
+        assert ret['notauser'] == []
+
     def testSearchUser(self):
         inv = Backend(cfg, cherrypy.log, 'test', attr, 'uid')
         inv.add_user(default_user)
@@ -95,6 +104,18 @@ class TestError(object):
         expected = ['default_user', 'default_user2']
         assert set(ret.keys()) == set(expected)
 
+    def testSearchSorted(self):
+        inv = Backend(cfg, cherrypy.log, 'test', attr, 'uid')
+        inv.add_user(default_user)
+        inv.add_user(default_user2)
+        ret, total = inv.search_sorted('default', '-uid', 0, 1)
+        assert list(ret.keys()) == ['default_user2']
+        assert total == 2
+        ret, total = inv.search_sorted('default', '-uid', 1, 1)
+        assert list(ret.keys()) == ['default_user']
+        ret, total = inv.search_sorted('default', 'uid')
+        assert list(ret.keys()) == ['default_user', 'default_user2']
+
     def testAddUser(self):
         try:
             inv.del_user(u'test☭')
@@ -6,7 +6,7 @@ from __future__ import unicode_literals
 
 import pytest
 import sys
-from ldapcherry.backend.backendLdap import Backend, CaFileDontExist
+from ldapcherry.backend.backendLdap import Backend, CaFileDontExist, ConnectionPool, FilterTemplate, WrongFilterTemplate, Server, WrongUri, NO_ATTR
 from ldapcherry.exceptions import *
 from disable import travis_disabled
 import cherrypy
@@ -96,6 +96,16 @@ class TestError(object):
         else:
             raise AssertionError("expected an exception")
 
+    def testConnectionOptions(self):
+        cfg2 = cfg.copy()
+        cfg2['checkcert'] = 'on'
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        options = dict(inv.ldap_options)
+        assert options[ldap.OPT_X_TLS_CACERTFILE] == cfg2['ca']
+        assert options[ldap.OPT_X_TLS_REQUIRE_CERT] == ldap.OPT_X_TLS_DEMAND
+        # the new tls context must be created after setting the options
+        assert inv.ldap_options[-1] == (ldap.OPT_X_TLS_NEWCTX, 0)
+
     def testConnectSSLWrongCA(self):
         cfg2 = cfg.copy()
         cfg2['uri'] = 'ldaps://ldap.ldapcherry.org:637'
@@ -120,6 +130,116 @@ class TestError(object):
         ldapc = inv._connect()
         ldapc.simple_bind_s(inv.binddn, inv.bindpassword)
 
+    def testPoolReuse(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        inv.get_user(u'jwatsoné')
+        inv.get_user(u'jwatsoné')
+        stats = inv.get_pool_stats()
+        assert stats['created'] == 1
+        assert stats['reused'] == 1
+        assert stats['in_use'] == 0
+        assert stats['idle'] == 1
+
+    def testOperationSingleConnection(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        groups = ['cn=hrpeople,ou=Groups,dc=example,dc=org']
+        inv.add_to_groups(u'jwatsoné', groups)
+        inv.del_from_groups(u'jwatsoné', groups)
+        stats = inv.get_pool_stats()
+        # one checkout per operation, shared by the searches
+        # and the modifications of the operation
+        assert stats['created'] == 1
+        assert stats['reused'] == 1
+
+    def testIterSearchClose(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        entries = inv._iter_search('(uid=*)', NO_ATTR, inv.userdn)
+        next(entries)
+        # caller stopping before the end of the search
+        entries.close()
+        stats = inv.get_pool_stats()
+        assert stats['in_use'] == 0
+        assert stats['idle'] == 1
+        assert not inv._in_operation()
+
+    def testPoolOverflow(self):
+        class FakeClient(object):
+            def unbind_s(self):
+                self.closed = True
+        pool = ConnectionPool(FakeClient, 1, 30)
+        c1 = pool.get()
+        c2 = pool.get()
+        pool.put(c1)
+        pool.put(c2)
+        stats = pool.stats()
+        assert stats['created'] == 2
+        assert stats['overflow'] == 1
+        assert stats['idle'] == 1
+        assert c2.closed
+        assert pool.get() is c1
+
+    def testServerBreaker(self):
+        class FakeClient(object):
+            def unbind_s(self):
+                pass
+        server = Server('ldap://a', 'ro', ConnectionPool(FakeClient, 1, 30), 2, 30)
+        assert not server.failure()
+        assert server.available()
+        assert server.failure()
+        assert not server.available()
+        server.success(0.1)
+        assert server.available()
+        assert server.failure(down=True)
+        assert not server.available()
+
+    def testUriList(self):
+        cfg2 = cfg.copy()
+        cfg2['uri'] = 'ldap://a [rw], ldap://b [ro],ldap://c[ro]'
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        servers = [(s.uri, s.role) for s in inv.servers]
+        assert servers == [('ldap://a', 'rw'), ('ldap://b', 'ro'), ('ldap://c', 'ro')]
+        assert [s.uri for s in inv._candidates(write=True)] == ['ldap://a']
+        inv.servers[1].failure(down=True)
+        candidates = [s.uri for s in inv._candidates()]
+        assert candidates == ['ldap://c', 'ldap://a', 'ldap://b']
+
+    def testWrongUri(self):
+        for uri in ['', 'notanuri', 'ldap://a [ro]', 'ldap://a [rx]']:
+            cfg2 = cfg.copy()
+            cfg2['uri'] = uri
+            try:
+                inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+            except WrongUri:
+                pass
+            else:
+                raise AssertionError("expected an exception")
+
+    def testDnCache(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        dn = inv._get_user(u'jwatsoné', NO_ATTR)
+        hits = inv.dn_cache.stats()['hits']
+        assert inv._get_user(u'jwatsoné', NO_ATTR) == dn
+        assert inv.dn_cache.stats()['hits'] == hits + 1
+        inv._invalidate_dn(u'jwatsoné')
+        assert inv._get_user(u'jwatsoné', NO_ATTR) == dn
+        assert inv.dn_cache.stats()['hits'] == hits + 1
+
+    def testFilterTemplate(self):
+        tmpl = FilterTemplate('search_filter_tmpl', '(|(uid=%(searchstring)s*)(sn=%(searchstring)s*))', ['searchstring'])
+        ret = tmpl.build({'searchstring': 'a*(b)'})
+        assert ret == '(|(uid=a\\2a\\28b\\29*)(sn=a\\2a\\28b\\29*))'
+
+    def testWrongFilterTemplate(self):
+        for tmpl in ['(uid=%(username)s', 'uid=%(username)s', '(uid=%(notakey)s)', '(&(uid=%(username)s)(cn=test)']:
+            cfg2 = cfg.copy()
+            cfg2['user_filter_tmpl'] = tmpl
+            try:
+                inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+            except WrongFilterTemplate:
+                pass
+            else:
+                raise AssertionError("expected an exception")
+
     def testAuthSuccess(self):
         inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
         ret = inv.auth(u'jwatsoné', u'passwordwatsoné')
@@ -142,6 +262,34 @@ class TestError(object):
         expected = ['cn=itpeople,ou=Groups,dc=example,dc=org']
         assert ret == expected
 
+    def testGetGroupsUserDontExists(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        ret = inv.get_groups(u'notauser')
+        assert ret == []
+
+    def testGetGroupsBulk(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        ret = inv.get_groups_bulk([u'jwatsoné', u'notauser'])
+        expected = {
+            u'jwatsoné': ['cn=itpeople,ou=Groups,dc=example,dc=org'],
+            u'notauser': [],
+        }
+        assert ret == expected
+
+    def testGetGroupsBulkFilter(self):
+        # same groups as get_groups, whatever the group filter
+        for tmpl in ['(member=uid=%(username)s,ou=People,dc=example,dc=org)',
+                     '(&(objectClass=*)(member=%(userdn)s))']:
+            cfg2 = cfg.copy()
+            cfg2['group_filter_tmpl'] = tmpl
+            inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+            ret = inv.get_groups_bulk([u'jwatsoné', u'notauser'])
+            expected = {
+                u'jwatsoné': inv.get_groups(u'jwatsoné'),
+                u'notauser': [],
+            }
+            assert ret == expected
+
     def testAddDeleteGroups(self):
         inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
         groups = [
@@ -154,12 +302,79 @@ class TestError(object):
         inv.del_from_groups(u'jwatsoné', ['cn=hrpeople,ou=Groups,dc=example,dc=org'])
         assert ret == ['cn=itpeople,ou=Groups,dc=example,dc=org', 'cn=hrpeople,ou=Groups,dc=example,dc=org']
 
+    def testGroupsModificationsResult(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        groups = [
+           'cn=hrpeople,ou=Groups,dc=example,dc=org',
+           'cn=itpeople,ou=Groups,dc=example,dc=org',
+        ]
+        ret = inv.add_to_groups(u'jwatsoné', groups)
+        assert ret['cn=hrpeople,ou=Groups,dc=example,dc=org'] == {'member': 'added'}
+        assert ret['cn=itpeople,ou=Groups,dc=example,dc=org'] == {'member': 'already_member'}
+        ret = inv.del_from_groups(u'jwatsoné', ['cn=hrpeople,ou=Groups,dc=example,dc=org'])
+        assert ret == {'cn=hrpeople,ou=Groups,dc=example,dc=org': {'member': 'removed'}}
+        ret = inv.del_from_groups(u'jwatsoné', ['cn=hrpeople,ou=Groups,dc=example,dc=org'])
+        assert ret == {'cn=hrpeople,ou=Groups,dc=example,dc=org': {'member': 'not_member'}}
+
+    def testGroupsModificationsSendError(self):
+        class FakeClient(object):
+            def __init__(self):
+                self.sent = []
+                self.read = []
+            def modify_ext(self, dn, ldif):
+                if len(self.sent) == 2:
+                    raise ldap.OPERATIONS_ERROR({'desc': 'error'})
+                self.sent.append(len(self.sent) + 1)
+                return self.sent[-1]
+            def result3(self, msgid):
+                self.read.append(msgid)
+            def unbind_s(self):
+                pass
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        client = FakeClient()
+        inv.servers[0].pool = ConnectionPool(lambda: client, 1, 30)
+        inv._get_user = lambda username, attrs: ('uid=test,ou=People,dc=example,dc=org', {})
+        groups = ['cn=group%d,ou=Groups,dc=example,dc=org' % i for i in range(3)]
+        try:
+            inv.add_to_groups(u'test', groups)
+        except Exception:
+            pass
+        else:
+            raise AssertionError("expected an exception")
+        # the answers of the modifications already sent were read
+        # before giving back the connection
+        assert client.read == client.sent == [1, 2]
+        assert inv.get_pool_stats()['in_use'] == 0
+
     def testSearchUser(self):
         inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
         ret = inv.search('smith')
         expected = {'ssmith': {'sn': 'smith', 'uid': 'ssmith', 'cn': 'Sheri Smith', 'userPassword': 'passwordsmith'}, 'jsmith': {'sn': 'Smith', 'uid': 'jsmith', 'cn': 'John Smith', 'userPassword': 'passwordsmith'}}
         assert ret == expected
 
+    def testSearchUserPaged(self):
+        cfg2 = cfg.copy()
+        cfg2['page_size'] = 1
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        ret = inv.search('smith')
+        expected = {'ssmith': {'sn': 'smith', 'uid': 'ssmith', 'cn': 'Sheri Smith', 'userPassword': 'passwordsmith'}, 'jsmith': {'sn': 'Smith', 'uid': 'jsmith', 'cn': 'John Smith', 'userPassword': 'passwordsmith'}}
+        assert ret == expected
+
+    def testSearchDisplayedAttrs(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        inv.set_displayed_attrs(['cn'])
+        ret = inv.search('smith')
+        expected = {'ssmith': {'uid': 'ssmith', 'cn': 'Sheri Smith'}, 'jsmith': {'uid': 'jsmith', 'cn': 'John Smith'}}
+        assert ret == expected
+
+    def testSearchSorted(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        ret, total = inv.search_sorted('smith', '-uid', 0, 1)
+        assert list(ret.keys()) == ['ssmith']
+        assert total == 2
+        ret, total = inv.search_sorted('smith', '-uid', 1, 1)
+        assert list(ret.keys()) == ['jsmith']
+
     def testAddUser(self):
         try:
             inv.del_user(u'test☭,cn=')
@@ -193,6 +408,26 @@ class TestError(object):
         inv.set_attrs(u'test☭', {'gecos': 'test2', 'homeDirectory': '/home/test/'})
         inv.del_user(u'test☭')
 
+    def testDnCacheModifyKey(self):
+        # key attribute (cn) different from the rdn attribute (uid)
+        cfg2 = cfg.copy()
+        cfg2['user_filter_tmpl'] = '(cn=%(username)s)'
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'cn')
+        user = {
+        'uid': u'test☭',
+        'sn':  u'test☭',
+        'cn':  u'test☭',
+        'userPassword': u'test☭',
+        'uidNumber': '42',
+        'gidNumber': '42',
+        'homeDirectory': '/home/test/'
+        }
+        inv.add_user(user)
+        assert inv._get_user(u'test☭', NO_ATTR) is not None
+        inv.set_attrs(u'test☭', {'cn': u'test2☭'})
+        assert inv._get_user(u'test☭', NO_ATTR) is None
+        inv.del_user(u'test2☭')
+
     def testAddUserDuplicate(self):
         inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
         user = {
@@ -227,7 +462,7 @@ class TestError(object):
     def testGetUser(self):
         inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
         ret = inv.get_user(u'jwatsoné')
-        expected = {'uid': u'jwatsoné', 'objectClass': 'inetOrgPerson', 'carLicense': 'HERCAR 125', 'sn': 'watson', 'mail': 'j.watson@example.com', 'homePhone': '555-111-2225', 'cn': 'John Watson', 'userPassword': u'passwordwatsoné'}
+        expected = {'uid': u'jwatsoné', 'sn': 'watson', 'cn': 'John Watson', 'userPassword': u'passwordwatsoné'}
         assert ret == expected
 
     def testAddUserMissingMustattribute(self):
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+from __future__ import unicode_literals
+
+import pytest
+import sys
+import json
+import cherrypy
+from cherrypy import Application
+from ldapcherry.cli import _shared_sessions, _check_workers
+from ldapcherry.cli import _disable_auth_cache, audit_roles
+from ldapcherry.sessions import SQLiteSession
+
+
+def app_config(config):
+    app = Application(None)
+    app.config = config
+    return app
+
+
+class TestError(object):
+
+    def testSharedSessions(self):
+        app = app_config({'/': {'tools.sessions.on': True}})
+        assert not _shared_sessions(app)
+        app = app_config({'/': {
+            'tools.sessions.on': True,
+            'tools.sessions.storage_type': 'file',
+            }})
+        assert _shared_sessions(app)
+        app = app_config({'/': {
+            'tools.sessions.on': True,
+            'tools.sessions.storage_class': SQLiteSession,
+            }})
+        assert _shared_sessions(app)
+        app = app_config({'/': {
+            'tools.sessions.on': True,
+            'tools.sessions.storage_class':
+                cherrypy.lib.sessions.RamSession,
+            }})
+        assert not _shared_sessions(app)
+        # no sessions, nothing to share
+        app = app_config({'/': {'tools.sessions.on': False}})
+        assert _shared_sessions(app)
+
+    def testCheckWorkers(self):
+        app = app_config({'/': {
+            'tools.sessions.on': True,
+            'tools.sessions.storage_class': SQLiteSession,
+            }})
+        assert _check_workers(app) is None
+        assert _check_workers(app, fastcgi=True) is not None
+        assert _check_workers(app, scgi=True) is not None
+        assert _check_workers(app, cgi=True) is not None
+        app = app_config({'/': {'tools.sessions.on': True}})
+        assert _check_workers(app) is not None
+
+    def testDisableAuthCache(self):
+        app = app_config({'auth': {'auth.cache_ttl': 60}})
+        assert _disable_auth_cache(app)
+        assert app.config['auth']['auth.cache_ttl'] == 0
+        assert not _disable_auth_cache(app)
+        app = app_config({'auth': {'auth.mode': 'or'}})
+        assert not _disable_auth_cache(app)
+
+    def testAuditRoles(self, capsys):
+        audit_roles('./tests/cfg/ldapcherry_demo.ini')
+        out, err = capsys.readouterr()
+        expected = {
+            'admin': {
+                'roles': ['sec-officer', 'users'],
+                'unusedgroups': {},
+            },
+            'user': {
+                'roles': ['users'],
+                'unusedgroups': {'demo': ['Test 1']},
+            },
+        }
+        assert json.loads(out) == expected
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+from __future__ import unicode_literals
+
+import pytest
+import sys
+import time
+from ldapcherry.lrucache import LRUCache
+
+
+class TestError(object):
+
+    def testGetSet(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.get('b', 2) == 2
+
+    def testEviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # 'a' becomes the most recently used entry
+        cache.get('a')
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert len(cache) == 2
+        assert cache.stats()['evictions'] == 1
+
+    def testTtl(self):
+        cache = LRUCache(2, 0.1)
+        cache.set('a', 1)
+        assert cache.get('a') == 1
+        time.sleep(0.2)
+        assert cache.get('a') is None
+
+    def testInvalidate(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.invalidate('a')
+        cache.invalidate('notakey')
+        assert cache.get('a') is None
+        cache.clear()
+        assert len(cache) == 0
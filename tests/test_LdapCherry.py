@@ -168,6 +168,103 @@ class TestError(object):
         assert ret2 == {'connected': True, 'isadmin': False} and \
             ret1 == {'connected': True, 'isadmin': False}
 
+    def testAuthCache(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry_test.ini', app)
+        app._init_auth({
+            'auth': {'auth.mode': 'or', 'auth.cache_ttl': 60},
+            'roles': {'roles.file': './tests/cfg/roles_test.yml'},
+        })
+        ret1 = app._auth('jsmith', 'passwordsmith')
+        # the backends are not queried anymore
+        backends = app.backends
+        app.backends = {}
+        ret2 = app._auth('jsmith', 'passwordsmith')
+        ret3 = app._auth('jsmith', 'wrongpassword')
+        app._invalidate_auth('jsmith')
+        ret4 = app._auth('jsmith', 'passwordsmith')
+        app.backends = backends
+        assert ret1 == ret2 == {'connected': True, 'isadmin': False}
+        assert ret3['connected'] == False
+        assert ret4['connected'] == False
+
+    def testAuthCacheCase(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry_test.ini', app)
+        app._init_auth({
+            'auth': {'auth.mode': 'or', 'auth.cache_ttl': 60},
+            'roles': {'roles.file': './tests/cfg/roles_test.yml'},
+        })
+        ret1 = app._auth('JSmith', 'passwordsmith')
+        backends = app.backends
+        app.backends = {}
+        # the user is modified with a login in another case
+        app._invalidate_auth('jsmith')
+        ret2 = app._auth('JSmith', 'passwordsmith')
+        app.backends = backends
+        assert ret1 == {'connected': True, 'isadmin': False}
+        assert ret2['connected'] == False
+
+    def testReloadFiles(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry_test.ini', app)
+        roles = app.roles
+        backends = app.backends
+        generation = app.files_generation
+        assert app.reload_files() == False
+        assert app.reload_files(True) == True
+        assert app.roles is not roles
+        assert app.files_generation == generation + 1
+        # same attributes, the backends are kept
+        assert app.backends['ldap'] is backends['ldap']
+        # invalid roles file, the current roles are kept
+        roles = app.roles
+        app.roles_file = './tests/cfg/roles_key_dup.yml'
+        assert app.reload_files(True) == False
+        assert app.roles is roles
+
+    def testSessionUserCache(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry_test.ini', app)
+        app.auth_mode = 'or'
+        app.session_cache_ttl = 60
+        cherrypy.session['_cp_username'] = 'jsmith'
+        attrs = app._get_session_user('attrs')
+        roles = app._get_session_user('roles')
+        # the backends are not queried anymore
+        backends = app.backends
+        app.backends = {}
+        assert app._get_session_user('attrs') == attrs
+        assert app._get_session_user('roles') == roles
+        app._refresh_session_user()
+        assert app._get_session_user('attrs') == {}
+        app.backends = backends
+        cherrypy.session.clear()
+
+    def testSessionAdminCache(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry_demo.ini', app)
+        app.session_cache_ttl = 60
+        cherrypy.session['_cp_username'] = 'admin'
+        cherrypy.session['connected'] = True
+        cherrypy.session['isadmin'] = True
+        assert app._check_admin()
+        # roles changed in the backend, the cached roles are used
+        app.backends['demo'].users['admin']['groups'] = set(['users'])
+        assert app._check_admin()
+        # the modification of the user drops his cached roles
+        app._refresh_session_user('admin')
+        assert not app._check_admin()
+        cherrypy.session.clear()
+
+    def testAuditRoles(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry_test.ini', app)
+        ret = app.audit_roles()
+        for user in ret:
+            expected = app._get_roles(user)
+            assert ret[user]['roles'] == sorted(expected['roles'])
+
     def testPPolicy(self):
         app = LdapCherry()
         loadconf('./tests/cfg/ldapcherry.ini', app)
@@ -254,6 +351,30 @@ class TestError(object):
         ret = app._search('smith')
         assert expected == ret
 
+    def testSearchWindow(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry_test.ini', app)
+        ret, window = app._search_page('smith', '-uid', '0', '1')
+        assert list(ret.keys()) == [u'ssmith']
+        assert window['total'] == 2
+        ret, window = app._search_page('smith', 'uid', '1', '1')
+        assert list(ret.keys()) == [u'ssmith']
+        try:
+            app._search_page('smith', 'notanattr', '0', '1')
+        except cherrypy.HTTPError:
+            return
+        else:
+            raise AssertionError("expected an exception")
+
+    def testSearchSequential(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry_test.ini', app)
+        expected_search = app._search('smith')
+        expected_groups = app._get_groups('jsmith')
+        app.fanout_pool = None
+        assert expected_search == app._search('smith')
+        assert expected_groups == app._get_groups('jsmith')
+
     def testGetUser(self):
         app = LdapCherry()
         loadconf('./tests/cfg/ldapcherry_test.ini', app)
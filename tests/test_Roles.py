@@ -6,9 +6,10 @@ from __future__ import unicode_literals
 
 import pytest
 import sys
+import json
 from ldapcherry.roles import Roles
 from ldapcherry.exceptions import DumplicateRoleKey, MissingKey, DumplicateRoleContent, MissingRolesFile, MissingRole
-from ldapcherry.pyyamlwrapper import DumplicatedKey, RelationError
+from ldapcherry.pyyamlwrapper import DumplicatedKey, RelationError, loadNoDump, MyLoader, NoDumpLoader
 if sys.version < '3':
     from sets import Set as set
 
@@ -193,3 +194,110 @@ class TestError(object):
         }
         expected = {'unusedgroups': {'toto': set(['not a group']), 'ad': set(['Domain Users 2'])}, 'roles': set(['developers', 'admin-lv2', 'users'])}
         assert inv.get_roles(groups) == expected
+
+    def testGetRoleCache(self):
+        inv = Roles('./tests/cfg/roles.yml')
+        groups = {
+        'ad' : ['Domain Users', 'Domain Users 2'],
+        'ldap': ['cn=users,ou=group,dc=example,dc=com'],
+        }
+        res1 = inv.get_roles(groups)
+        # modifying the result must not alter the cached one
+        res1['roles'].add('notarole')
+        res1['unusedgroups']['ad'].add('notagroup')
+        groups['ad'].reverse()
+        res2 = inv.get_roles(groups)
+        expected = {'unusedgroups': {'ad': set(['Domain Users 2'])}, 'roles': set(['users'])}
+        assert res2 == expected
+        assert inv.roles_cache.stats()['hits'] == 1
+        nocache = Roles('./tests/cfg/roles.yml', cache_size=0)
+        assert nocache.get_roles(groups) == expected
+
+    def testSerialized(self):
+        inv = Roles('./tests/cfg/roles.yml')
+        graph = json.loads(inv.graph_js)
+        assert set(graph['users']['parent_roles']) == inv.graph['users']['parent_roles']
+        assert json.loads(inv.roles_js) == inv.display_names
+        assert inv.display_names['users'] == 'Simple Users'
+
+    def testNestedDeep(self):
+        inv = Roles('./tests/cfg/nested_deep.yml')
+        # only the direct sub roles are nested
+        assert list(inv.roles['users']['subroles'].keys()) == ['developers']
+        lv2 = inv.roles['developers']['subroles']['developers-lv2']
+        assert list(lv2['subroles'].keys()) == ['developers-lv3']
+        assert inv.graph['developers-lv4']['parent_roles'] == \
+            set(['users', 'developers', 'developers-lv2', 'developers-lv3'])
+        groups = {'ldap': [
+            'cn=users,ou=group,dc=example,dc=com',
+            'cn=developers,ou=group,dc=example,dc=com',
+            'cn=developers lv2,ou=group,dc=example,dc=com',
+        ]}
+        expected = set(['users', 'developers', 'developers-lv2'])
+        assert inv.get_roles(groups)['roles'] == expected
+
+    def testRoleMatcher(self):
+        inv = Roles('./tests/cfg/roles.yml')
+        matcher = inv.matcher
+        users = matcher.bits[('ad', 'Domain Users')] | \
+            matcher.bits[('ldap', 'cn=users,ou=group,dc=example,dc=com')]
+        assert matcher.mask({'ad': ['Domain Users', 'unknown'],
+            'ldap': ['cn=users,ou=group,dc=example,dc=com']}) == users
+        assert matcher.match({}) == {'roles': set([]), 'unusedgroups': {}}
+        groups = {'ad': ['Domain Users']}
+        expected = {'unusedgroups': {'ad': set(['Domain Users'])}, 'roles': set([])}
+        assert matcher.match(groups) == expected
+
+    def testGetRolesBulk(self):
+        inv = Roles('./tests/cfg/roles.yml')
+        groups = {
+        'ad' : ['Domain Users', 'Domain Users 2'],
+        'ldap': ['cn=users,ou=group,dc=example,dc=com'],
+        }
+        ret = inv.get_roles_bulk({'user1': groups, 'user2': groups, 'user3': {}})
+        expected = {'unusedgroups': {'ad': set(['Domain Users 2'])}, 'roles': set(['users'])}
+        assert ret['user1'] == expected
+        assert ret['user2'] == expected
+        assert ret['user1'] is not ret['user2']
+        assert ret['user3'] == {'unusedgroups': {}, 'roles': set([])}
+
+    def testGroupsRemoveDeep(self):
+        inv = Roles('./tests/cfg/nested_deep.yml')
+        assert inv.subroles_closure['developers-lv2'] == \
+            frozenset(['developers-lv3', 'developers-lv4'])
+        groups = inv.get_groups_to_remove(
+                ['users', 'developers', 'developers-lv2', 'developers-lv4'],
+                ['developers-lv2']
+        )
+        expected = {'ldap': set([
+            'cn=developers lv2,ou=group,dc=example,dc=com',
+            'cn=developers lv3,ou=group,dc=example,dc=com',
+            'cn=developers lv4,ou=group,dc=example,dc=com',
+        ])}
+        assert groups == expected
+
+    def testCompiled(self, tmpdir):
+        compiled_file = str(tmpdir.join('roles.compiled'))
+        inv = Roles('./tests/cfg/roles.yml', compiled_file=compiled_file)
+        assert inv.compiled == False
+        inv.save_compiled(compiled_file)
+        inv2 = Roles('./tests/cfg/roles.yml', compiled_file=compiled_file)
+        assert inv2.compiled == True
+        assert inv2.flatten == inv.flatten
+        assert inv2.graph == inv.graph
+        groups = {'ldap': ['cn=users,ou=group,dc=example,dc=com'], 'ad': ['Domain Users']}
+        assert inv2.get_roles(groups) == inv.get_roles(groups)
+        # compiled from another roles file, not used
+        inv3 = Roles('./tests/cfg/nested.yml', compiled_file=compiled_file)
+        assert inv3.compiled == False
+        assert inv3.flatten != inv.flatten
+
+    def testYamlLoaders(self):
+        with open('./tests/cfg/roles.yml') as f:
+            content = f.read()
+        assert loadNoDump(content) == loadNoDump(content, MyLoader)
+        with open('./tests/cfg/roles_key_dup.yml') as f:
+            content = f.read()
+        for loader in (NoDumpLoader, MyLoader):
+            with pytest.raises(DumplicatedKey):
+                loadNoDump(content, loader)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+from __future__ import unicode_literals
+
+import pytest
+import sys
+import datetime
+from ldapcherry.sessions import SQLiteSession
+
+
+def setup_db(tmpdir):
+    path = str(tmpdir.join('sessions.db'))
+    SQLiteSession.setup(storage_path=path)
+    return path
+
+
+def new_session(id=None):
+    # clean_freq=0: no clean up thread, the lock is released by save()
+    sess = SQLiteSession(id, timeout=10, clean_freq=0)
+    sess.acquire_lock()
+    return sess
+
+
+def stored_expiration(sess):
+    return sess._connect().execute(
+        'SELECT expiration FROM session WHERE id = ?',
+        (sess.id,),
+        ).fetchone()[0]
+
+
+class TestError(object):
+
+    def testSaveLoad(self, tmpdir):
+        setup_db(tmpdir)
+        sess = new_session()
+        sess['user'] = 'jwatson'
+        sess.save()
+        sess = new_session(sess.id)
+        assert sess['user'] == 'jwatson'
+        assert len(sess) == 1
+        sess.release_lock()
+
+    def testWriteOnlyIfDirty(self, tmpdir):
+        setup_db(tmpdir)
+        sess = new_session()
+        sess['user'] = 'jwatson'
+        sess.save()
+        expiration = stored_expiration(sess)
+        # read only request, nothing is written
+        sess = new_session(sess.id)
+        assert sess.get('user') == 'jwatson'
+        sess.save()
+        assert stored_expiration(sess) == expiration
+        # modified session is written back
+        sess = new_session(sess.id)
+        sess['isadmin'] = True
+        sess.save()
+        assert stored_expiration(sess) > expiration
+        sess = new_session(sess.id)
+        assert sess['isadmin'] is True
+        sess.release_lock()
+
+    def testRefreshExpiration(self, tmpdir):
+        setup_db(tmpdir)
+        sess = new_session()
+        sess['user'] = 'jwatson'
+        sess.save()
+        id = sess.id
+        # less than half of the timeout left: the expiration is refreshed
+        sess._connect().execute(
+            'UPDATE session SET expiration = expiration - 400'
+            )
+        expiration = stored_expiration(sess)
+        sess = new_session(id)
+        assert sess['user'] == 'jwatson'
+        sess.save()
+        assert stored_expiration(sess) > expiration
+
+    def testRegenerate(self, tmpdir):
+        setup_db(tmpdir)
+        sess = new_session()
+        sess['user'] = 'jwatson'
+        sess.save()
+        old_id = sess.id
+        sess = new_session(old_id)
+        sess.load()
+        sess.regenerate()
+        sess.save()
+        assert sess.id != old_id
+        sess = new_session(sess.id)
+        assert sess['user'] == 'jwatson'
+        sess.release_lock()
+        assert new_session(old_id).id != old_id
+
+    def testCleanUp(self, tmpdir):
+        setup_db(tmpdir)
+        sess = new_session()
+        sess['user'] = 'jwatson'
+        sess.save()
+        id = sess.id
+        sess._connect().execute(
+            'UPDATE session SET expiration = expiration - 700'
+            )
+        assert len(sess) == 0
+        sess.clean_up()
+        assert sess._exists() is False
+        assert new_session(id).id != id